@@ -0,0 +1,484 @@
+#########################################################
+### ast based unpacking of value yields (lifting them) ###
+#########################################################
+import ast
+from dis import get_instructions
+from types import GeneratorType
+
+from gcopy.state_machine import contains
+from gcopy.utils import getcode, getframe
+
+## the key prefix of the lifted values in locals()['.internals'] ##
+LIFTED = ".lift"
+
+YIELDS = (ast.Yield, ast.YieldFrom)
+SCOPES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)
+
+
+def has_yield(node: ast.AST) -> bool:
+    """Checks if an expression is or contains a yield (not including nested scopes)"""
+    return isinstance(node, YIELDS) or contains(node, YIELDS)
+
+
+def mark_plain(node: ast.AST, yields: list[ast.AST]) -> bool:
+    """
+    Marks the nodes that are or contain a yield (not including nested
+    scopes) in a single pass via a 'plain' attribute (False if they do)
+    adding the yields found to yields; the nodes without the attribute
+    are the ones added by YieldLifter
+    """
+    node.plain = not isinstance(node, YIELDS)
+    if isinstance(node, SCOPES):
+        return True
+    if not node.plain:
+        yields += [node]
+    for child in ast.iter_child_nodes(node):
+        if not mark_plain(child, yields):
+            node.plain = False
+    return node.plain
+
+
+def internals(key: str, ctx: ast.expr_context = ast.Load()) -> ast.Subscript:
+    """locals()['.internals'][key]"""
+    node = ast.Subscript(
+        ast.Subscript(ast.Call(ast.Name("locals", ast.Load()), [], []), ast.Constant(".internals"), ast.Load()),
+        ast.Constant(key),
+        ctx,
+    )
+    ## the source is recorded so that it doesn't need unparsing (see SourceEmitter.text) ##
+    node.source = "locals()['.internals'][%r]" % key
+    return node
+
+
+def internals_pop(key: str) -> ast.Call:
+    """locals()['.internals'].pop(key)"""
+    node = ast.Call(
+        ast.Attribute(
+            ast.Subscript(ast.Call(ast.Name("locals", ast.Load()), [], []), ast.Constant(".internals"), ast.Load()),
+            "pop",
+            ast.Load(),
+        ),
+        [ast.Constant(key)],
+        [],
+    )
+    node.source = "locals()['.internals'].pop(%r)" % key
+    return node
+
+
+class YieldLifter(ast.NodeTransformer):
+    """
+    Lifts value yields, ternaries and short circuits containing yields,
+    walrus targets of yields, and yield froms into statements before
+    the statement they're in, such that the only yields left are yield
+    statements (that custom_adjustment turns into returns)
+
+    i.e. print((yield 1) + 2) becomes:
+
+    yield 1
+    locals()['.internals']['.lift0'] = locals()['.internals']['.send']
+    print(locals()['.internals'].pop('.lift0') + 2)
+
+    Note: the values of yield froms are not retrieved (they're None) and
+    anything evaluated before a yield in the same statement is evaluated
+    after it instead (the same as with unpack)
+
+    The expressions replacing others get a 'replaces' attribute of the
+    expression they replace and the yields get a 'resumable' attribute of whether there are no lifted
+    values pending at them (otherwise a running generator suspended there
+    can't be resumed since the pending values are on its value stack)
+    """
+
+    def __init__(self) -> None:
+        self.count, self.lifted, self.stmt, self.pending = 0, [], None, 0
+
+    @staticmethod
+    def has_yield(node: ast.AST) -> bool:
+        """has_yield via the marks of mark_plain if it's been marked"""
+        plain = getattr(node, "plain", None)
+        return has_yield(node) if plain is None else not plain
+
+    @staticmethod
+    def replace(new: ast.expr, node: ast.expr) -> ast.expr:
+        new.replaces = node
+        return new
+
+    def key(self) -> str:
+        self.count += 1
+        return LIFTED + str(self.count - 1)
+
+    def lift(self, *stmts: ast.stmt) -> None:
+        """adds statements before the current statement (at its location)"""
+        for stmt in stmts:
+            self.lifted += [self.locate(stmt)]
+
+    def locate(self, stmt: ast.stmt) -> ast.stmt:
+        """gives a lifted statement and the statements in its blocks the location of the current statement"""
+        if not hasattr(stmt, "lineno"):
+            ast.copy_location(stmt, self.stmt)
+        for child in getattr(stmt, "body", []) + getattr(stmt, "orelse", []):
+            self.locate(child)
+        return stmt
+
+    def expr(self, node: ast.expr | None, lifted: list[ast.stmt]) -> ast.expr | None:
+        """visits an expression recording the lifted statements in lifted"""
+        if node is None:
+            return None
+        outer, self.lifted = self.lifted, lifted
+        node = self.visit(node)
+        self.lifted = outer
+        return node
+
+    ## nested scopes are left as is ##
+    def visit_Lambda(self, node: ast.Lambda) -> ast.AST:
+        return node
+
+    def visit_Yield(self, node: ast.Yield) -> ast.AST:
+        ## the values lifted in its value are used by the time it yields ##
+        pending = self.pending
+        node.value = self.visit(node.value) if node.value else None
+        node.resumable, self.pending = not pending, pending + 1
+        key = self.key()
+        self.lift(ast.Expr(node), ast.Assign([internals(key, ast.Store())], internals(".send")))
+        return self.replace(internals_pop(key), node)
+
+    def visit_YieldFrom(self, node: ast.YieldFrom) -> ast.AST:
+        pending = self.pending
+        node.value = self.visit(node.value)
+        node.resumable, self.pending = not pending, pending
+        self.lift(ast.Expr(node))
+        return self.replace(ast.Constant(None), node)
+
+    def visit_NamedExpr(self, node: ast.NamedExpr) -> ast.AST:
+        if not self.has_yield(node.value):
+            return node
+        pending = self.pending
+        self.lift(ast.Assign([ast.Name(node.target.id, ast.Store())], self.visit(node.value)))
+        self.pending = pending
+        return self.replace(ast.Name(node.target.id, ast.Load()), node)
+
+    def visit_IfExp(self, node: ast.IfExp) -> ast.AST:
+        pending = self.pending
+        node.test = self.visit(node.test)
+        if not (self.has_yield(node.body) or self.has_yield(node.orelse)):
+            return node
+        key, body, orelse = self.key(), [], []
+        ## the test is used before either branch is run ##
+        self.pending = pending
+        node.body = self.expr(node.body, body)
+        self.pending = pending
+        node.orelse = self.expr(node.orelse, orelse)
+        self.pending = pending + 1
+        self.lift(
+            ast.If(
+                node.test,
+                body + [ast.Assign([internals(key, ast.Store())], node.body)],
+                orelse + [ast.Assign([internals(key, ast.Store())], node.orelse)],
+            )
+        )
+        return self.replace(internals_pop(key), node)
+
+    def visit_BoolOp(self, node: ast.BoolOp) -> ast.AST:
+        pending = self.pending
+        node.values[0] = self.visit(node.values[0])
+        if not any(map(self.has_yield, node.values[1:])):
+            return node
+        key = self.key()
+        self.lift(ast.Assign([internals(key, ast.Store())], node.values[0]))
+        for value in node.values[1:]:
+            lifted, self.pending = [], pending + 1
+            value = self.expr(value, lifted)
+            test = internals(key)
+            if isinstance(node.op, ast.Or):
+                test = ast.UnaryOp(ast.Not(), test)
+            self.lift(ast.If(test, lifted + [ast.Assign([internals(key, ast.Store())], value)], []))
+        self.pending = pending + 1
+        return self.replace(internals_pop(key), node)
+
+    def block(self, stmts: list[ast.stmt]) -> list[ast.stmt]:
+        """lifts the value yields of a block of statements"""
+        new_stmts = []
+        for stmt in stmts:
+            new_stmts += self.statement(stmt)
+        return new_stmts
+
+    def statement(self, stmt: ast.stmt) -> list[ast.stmt]:
+        """lifts the value yields of a statement returning the statements it becomes"""
+        if isinstance(stmt, SCOPES) or not self.has_yield(stmt):
+            return [stmt]
+        outer = (self.stmt, self.lifted, self.pending)
+        self.stmt, self.lifted, self.pending = stmt, [], 0
+        try:
+            return self._statement(stmt)
+        finally:
+            self.stmt, self.lifted, self.pending = outer
+
+    def _statement(self, stmt: ast.stmt) -> list[ast.stmt]:
+        ## yield statements only need their values lifted ##
+        if isinstance(stmt, ast.Expr) and isinstance(stmt.value, YIELDS):
+            if stmt.value.value:
+                stmt.value.value = self.visit(stmt.value.value)
+            stmt.value.resumable = True
+            return self.lifted + [stmt]
+        ## '... = yield ...' ##
+        if isinstance(stmt, (ast.Assign, ast.AnnAssign, ast.AugAssign)) and isinstance(stmt.value, ast.Yield):
+            if stmt.value.value:
+                stmt.value.value = self.visit(stmt.value.value)
+            stmt.value.resumable = True
+            self.lift(ast.Expr(stmt.value))
+            stmt.value = self.replace(internals(".send"), stmt.value)
+            return self.lifted + [stmt]
+        if isinstance(stmt, (ast.If, ast.While)):
+            if isinstance(stmt, ast.While) and self.has_yield(stmt.test):
+                ## the condition is lifted into the loop (a loops else block can't be kept) ##
+                if stmt.orelse:
+                    return [stmt]
+                self.lift(ast.If(ast.UnaryOp(ast.Not(), self.visit(stmt.test)), [ast.Break()], []))
+                stmt.body, stmt.test, self.lifted = self.lifted + self.block(stmt.body), ast.Constant(True), []
+                return [stmt]
+            stmt.test = self.visit(stmt.test)
+            stmt.body, stmt.orelse = self.block(stmt.body), self.block(stmt.orelse)
+            return self.lifted + [stmt]
+        if isinstance(stmt, (ast.For, ast.AsyncFor)):
+            stmt.iter = self.visit(stmt.iter)
+            stmt.body, stmt.orelse = self.block(stmt.body), self.block(stmt.orelse)
+            return self.lifted + [stmt]
+        if isinstance(stmt, (ast.With, ast.AsyncWith)):
+            for item in stmt.items:
+                item.context_expr = self.visit(item.context_expr)
+            stmt.body = self.block(stmt.body)
+            return self.lifted + [stmt]
+        if isinstance(stmt, (ast.Try, getattr(ast, "TryStar", ast.Try))):
+            stmt.body, stmt.orelse, stmt.finalbody = (
+                self.block(stmt.body),
+                self.block(stmt.orelse),
+                self.block(stmt.finalbody),
+            )
+            for handler in stmt.handlers:
+                handler.body = self.block(handler.body)
+            return [stmt]
+        if isinstance(stmt, getattr(ast, "Match", ())):
+            stmt.subject = self.visit(stmt.subject)
+            for case in stmt.cases:
+                case.body = self.block(case.body)
+            return self.lifted + [stmt]
+        return self.lifted + [self.generic_visit(stmt)]
+
+
+class SourceEmitter:
+    """
+    Emits a lifted function body (see YieldLifter) in the form of the
+    source_lines of clean_source_lines (yield statements become returns,
+    returns raise EOF and nonlocals are removed) recording the
+    jump_positions of its loops and the emitted lineno of its yields
+
+    The nodes on one line are emitted from the source with the expressions
+    replaced by the lifting spliced in (otherwise they're unparsed)
+    """
+
+    def __init__(self, source_lines: list[str]) -> None:
+        self.source_lines, self.lines, self.linenos, self.jump_positions, self.yields = source_lines, [], [], [], {}
+
+    def emit(self, indent: int, line: str, lineno: int) -> None:
+        """adds a line recording the lineno of the statement it's from"""
+        self.lines += [" " * indent + line]
+        self.linenos += [lineno]
+
+    def text(self, node: ast.AST) -> str:
+        """the source of a node"""
+        if hasattr(node, "source"):
+            return node.source
+        if hasattr(node, "plain") and node.lineno == node.end_lineno:
+            line = self.source_lines[node.lineno - 1]
+            spans = [] if node.plain else self.splice(node)
+            if spans is not None:
+                ## the col_offsets are utf-8 byte offsets ##
+                if line.isascii():
+                    return self.join(line, node, spans)
+                return self.join(line.encode(), node, [(*span[:2], span[2].encode()) for span in spans]).decode()
+        elif isinstance(node, ast.Assign) and len(node.targets) == 1:
+            return "%s = %s" % (self.text(node.targets[0]), self.text(node.value))
+        return ast.unparse(node)
+
+    @staticmethod
+    def join(line: str | bytes, node: ast.AST, spans: list[tuple[int, int, str | bytes]]) -> str | bytes:
+        """the source of a node in line with the spans replaced"""
+        parts, start = [], node.col_offset
+        for col_offset, end_col_offset, text in spans:
+            parts += [line[start:col_offset], text]
+            start = end_col_offset
+        return line[:0].join(parts + [line[start : node.end_col_offset]])
+
+    def splice(self, node: ast.AST) -> list[tuple[int, int, str]] | None:
+        """
+        The spans (col_offset, end_col_offset, text) of the expressions
+        replaced by the lifting in a node or None if it can't be spliced
+        """
+        ## the positions within f-strings are unreliable before python 3.12 ##
+        if isinstance(node, ast.JoinedStr):
+            return None
+        spans = []
+        for child in ast.iter_child_nodes(node):
+            if not hasattr(child, "plain"):
+                if not hasattr(child, "replaces"):
+                    return None
+                spans += [(child.replaces.col_offset, child.replaces.end_col_offset, self.text(child))]
+            elif not child.plain:
+                child_spans = self.splice(child)
+                if child_spans is None:
+                    return None
+                spans += child_spans
+        return sorted(spans)
+
+    def block(self, stmts: list[ast.stmt], indent: int) -> None:
+        length = len(self.lines)
+        for stmt in stmts:
+            self.statement(stmt, indent)
+        ## i.e. a block of nonlocals ##
+        if len(self.lines) == length:
+            self.emit(indent, "pass", stmts[0].lineno)
+
+    def loop(self, header: str, stmt: ast.For | ast.AsyncFor | ast.While, indent: int) -> None:
+        self.emit(indent, header, stmt.lineno)
+        jump_position = [len(self.lines)] * 2
+        self.jump_positions += [jump_position]
+        self.block(stmt.body, indent + 4)
+        jump_position[1] = len(self.lines)
+        if stmt.orelse:
+            self.emit(indent, "else:", stmt.orelse[0].lineno)
+            self.block(stmt.orelse, indent + 4)
+
+    def yield_statement(self, node: ast.Yield | ast.YieldFrom, indent: int, lineno: int) -> None:
+        if isinstance(node, ast.Yield):
+            self.yields.setdefault(node.lineno, []).append((node.col_offset, len(self.lines) + 1, node.resumable))
+            self.emit(indent, "return " + self.text(node.value) if node.value else "return", lineno)
+            return
+        from gcopy.source_processing import yield_adjust
+
+        ## resumes after the 'return' of the loop ##
+        self.yields.setdefault(node.lineno, []).append((node.col_offset, len(self.lines) + 4, node.resumable))
+        self.jump_positions += [[len(self.lines) + 2, len(self.lines) + 5]]
+        for line in yield_adjust("yield from " + self.text(node.value), " " * indent):
+            self.lines += [line]
+            self.linenos += [lineno]
+
+    def statement(self, stmt: ast.stmt, indent: int) -> None:
+        lineno = stmt.lineno
+        if isinstance(stmt, ast.Expr) and isinstance(stmt.value, YIELDS):
+            self.yield_statement(stmt.value, indent, lineno)
+        elif isinstance(stmt, ast.Return):
+            value = self.text(stmt.value) if stmt.value else ""
+            self.emit(indent, "return locals()['.internals']['EOF'](%s)" % value, lineno)
+        elif isinstance(stmt, ast.Nonlocal):
+            return
+        elif isinstance(stmt, ast.If):
+            self.emit(indent, "if %s:" % self.text(stmt.test), lineno)
+            self.block(stmt.body, indent + 4)
+            while stmt.orelse:
+                if len(stmt.orelse) == 1 and isinstance(stmt.orelse[0], ast.If):
+                    stmt = stmt.orelse[0]
+                    self.emit(indent, "elif %s:" % self.text(stmt.test), stmt.lineno)
+                    self.block(stmt.body, indent + 4)
+                else:
+                    self.emit(indent, "else:", stmt.orelse[0].lineno)
+                    self.block(stmt.orelse, indent + 4)
+                    break
+        elif isinstance(stmt, (ast.For, ast.AsyncFor)):
+            header = "for %s in %s:" % (self.text(stmt.target), self.text(stmt.iter))
+            self.loop("async " * isinstance(stmt, ast.AsyncFor) + header, stmt, indent)
+        elif isinstance(stmt, ast.While):
+            self.loop("while %s:" % self.text(stmt.test), stmt, indent)
+        elif isinstance(stmt, (ast.With, ast.AsyncWith)):
+            items = (
+                self.text(item.context_expr) + (" as " + self.text(item.optional_vars) if item.optional_vars else "")
+                for item in stmt.items
+            )
+            self.emit(indent, "async " * isinstance(stmt, ast.AsyncWith) + "with %s:" % ", ".join(items), lineno)
+            self.block(stmt.body, indent + 4)
+        elif isinstance(stmt, (ast.Try, getattr(ast, "TryStar", ast.Try))):
+            self.emit(indent, "try:", lineno)
+            self.block(stmt.body, indent + 4)
+            keyword = "except*" if type(stmt).__name__ == "TryStar" else "except"
+            for handler in stmt.handlers:
+                header = keyword + (" " + self.text(handler.type) if handler.type else "")
+                self.emit(indent, header + (" as " + handler.name if handler.name else "") + ":", handler.lineno)
+                self.block(handler.body, indent + 4)
+            for keyword, block in (("else:", stmt.orelse), ("finally:", stmt.finalbody)):
+                if block:
+                    self.emit(indent, keyword, block[0].lineno)
+                    self.block(block, indent + 4)
+        elif isinstance(stmt, getattr(ast, "Match", ())):
+            self.emit(indent, "match %s:" % self.text(stmt.subject), lineno)
+            for case in stmt.cases:
+                guard = " if " + self.text(case.guard) if case.guard else ""
+                self.emit(indent + 4, "case %s%s:" % (self.text(case.pattern), guard), case.pattern.lineno)
+                self.block(case.body, indent + 8)
+        else:
+            ## simple statements and nested scopes ##
+            for line in self.text(stmt).split("\n"):
+                self.emit(indent, line, lineno)
+
+
+def emit_source(source: str, running: bool = False) -> tuple[list[str], list[list[int]], list] | None:
+    """
+    Lifts the value yields of a function generators source (see YieldLifter)
+    and emits its source_lines, jump_positions and linetable (see SourceEmitter)
+
+    Returns None if the source is not a function definition or has yields
+    that can't be lifted. The linetable (only made if running) maps the lines
+    of the source to the emitted lineno of their yield (or the last emitted
+    lineno otherwise); lines with more than one yield or a yield that can't
+    be resumed from are mapped to a tuple of (col_offset, lineno or None)
+    pairs instead (see resume_lineno)
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    if len(tree.body) != 1 or not isinstance(tree.body[0], (ast.FunctionDef, ast.AsyncFunctionDef)):
+        return None
+    FUNC, yields = tree.body[0], []
+    for stmt in FUNC.body:
+        mark_plain(stmt, yields)
+    body = YieldLifter().block(FUNC.body)
+    ## the yields that weren't lifted e.g. in an exception handlers type ##
+    if not all(hasattr(node, "resumable") for node in yields):
+        return None
+    emitter = SourceEmitter(source.split("\n"))
+    emitter.block(body, 4)
+    linetable, index = [], 0
+    if running:
+        for lineno in range(1, len(emitter.source_lines) + 1):
+            while index < len(emitter.linenos) and emitter.linenos[index] <= lineno:
+                index += 1
+            linetable += [index]
+        for lineno, yields in emitter.yields.items():
+            if len(yields) == 1 and yields[0][2]:
+                linetable[lineno - 1] = yields[0][1]
+            else:
+                linetable[lineno - 1] = tuple(
+                    (col_offset, index if resumable else None) for col_offset, index, resumable in yields
+                )
+    return emitter.lines, emitter.jump_positions, linetable
+
+
+def resume_lineno(entry: int | tuple, FUNC: GeneratorType) -> int:
+    """
+    Resolves a linetable entry of emit_source for a running generator
+    via the column of the yield it's suspended at (the positions of the
+    instruction at its f_lasti); raises a ValueError if it's suspended
+    at a yield that can't be resumed from
+    """
+    if isinstance(entry, int):
+        return entry
+    lasti = getframe(FUNC).f_lasti
+    ## positions were added in python 3.11 ##
+    instructions = (instruction for instruction in get_instructions(getcode(FUNC)) if instruction.offset == lasti)
+    positions = getattr(next(instructions, None), "positions", None)
+    col_offset = getattr(positions, "col_offset", None)
+    for col, lineno in entry:
+        if col == col_offset and lineno is not None:
+            return lineno
+    raise ValueError(
+        "a running generator can't be resumed from a yield that's evaluated after "
+        "another value yield in the same statement (the sent value is on its value stack)"
+    )
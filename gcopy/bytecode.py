@@ -0,0 +1,261 @@
+###########################################################
+### bytecode level resuming of generators (CPython 3.12) ###
+###########################################################
+from ctypes import POINTER, Structure, c_char, c_int, c_ssize_t, c_uint16, c_void_p, py_object, sizeof
+from dis import _parse_exception_table
+from inspect import GEN_CLOSED, GEN_CREATED, GEN_RUNNING, getgeneratorstate
+from sys import version_info
+from types import CellType, CodeType, FrameType, FunctionType, GeneratorType
+
+from opcode import opmap
+
+from gcopy.utils import code_attrs, empty_generator, getcode, getframe
+
+## the memory layouts used are specific to CPython 3.12 ##
+supported = version_info[:2] == (3, 12)
+
+
+class BytecodeError(ValueError):
+    """Raised when a generator cannot be resumed at the bytecode level"""
+
+
+class NULL:
+    """Marks a NULL entry on a frames value stack (i.e. pushed before calls)"""
+
+
+class FrameView(Structure):
+    """
+    Used to access c level variables of the frame object
+
+    class follows on from the builtin layout:
+    https://github.com/python/cpython/blob/v3.12.1/Include/internal/pycore_frame.h#L16-L27
+    """
+
+    _fields_ = [
+        ## from macro PyObject_HEAD ##
+        ("refcount", c_ssize_t),
+        ("type", POINTER(py_object)),
+        ("f_back", c_void_p),
+        ("f_frame", c_void_p),  # the _PyInterpreterFrame
+    ]
+
+
+class InterpreterFrameView(Structure):
+    """
+    Used to access c level variables of _PyInterpreterFrame
+    (the frame data that is owned by the generator)
+
+    class follows on from the builtin layout:
+    https://github.com/python/cpython/blob/v3.12.1/Include/internal/pycore_frame.h#L49-L69
+    """
+
+    _fields_ = [
+        ("f_code", c_void_p),
+        ("previous", c_void_p),
+        ("f_funcobj", c_void_p),
+        ("f_globals", c_void_p),
+        ("f_builtins", c_void_p),
+        ("f_locals", c_void_p),
+        ("frame_obj", c_void_p),
+        ("prev_instr", c_void_p),
+        ("stacktop", c_int),
+        ("return_offset", c_uint16),
+        ("owner", c_char),
+        ## followed by localsplus e.g. the locals, cells, freevars and then the value stack ##
+    ]
+
+
+def localsplus_names(code_obj: CodeType) -> tuple[str, ...]:
+    """The names of the fast locals in order of their index (e.g. localsplus)"""
+    return (
+        code_obj.co_varnames
+        + tuple(name for name in code_obj.co_cellvars if name not in code_obj.co_varnames)
+        + code_obj.co_freevars
+    )
+
+
+def value_stack(frame: FrameType) -> list:
+    """Gets the value stack of a suspended frame (NULL entries are recorded as NULL)"""
+    interpreter_frame = FrameView.from_address(id(frame)).f_frame
+    view = InterpreterFrameView.from_address(interpreter_frame)
+    address = interpreter_frame + sizeof(InterpreterFrameView)
+    stack = []
+    for index in range(len(localsplus_names(frame.f_code)), view.stacktop):
+        item = address + index * sizeof(c_void_p)
+        if c_void_p.from_address(item).value is None:
+            stack += [NULL]
+        else:
+            stack += [py_object.from_address(item).value]
+    return stack
+
+
+def instruction(opname: str, arg: int = 0) -> bytes:
+    """Creates an instruction (with EXTENDED_ARG prefixes as needed)"""
+    prefix = b""
+    for shift in (24, 16, 8):
+        if arg >> shift:
+            prefix += bytes((opmap["EXTENDED_ARG"], (arg >> shift) & 0xFF))
+    return prefix + bytes((opmap[opname], arg & 0xFF))
+
+
+def jump(opname: str, arg: int) -> bytes:
+    """Creates a jump instruction with a fixed size of 2 code units"""
+    if arg > 0xFFFF:
+        raise BytecodeError("code object is too large to resume")
+    return bytes((opmap["EXTENDED_ARG"], arg >> 8, opmap[opname], arg & 0xFF))
+
+
+def varint(value: int, msb: int = 0) -> bytes:
+    """Encodes a value in the format of the exception table (6 bits per byte)"""
+    chunks = [value & 0x3F]
+    value >>= 6
+    while value:
+        chunks += [value & 0x3F | 0x40]
+        value >>= 6
+    chunks[-1] |= msb
+    return bytes(reversed(chunks))
+
+
+def exception_entry(start: int, end: int, target: int, depth: int, lasti: bool) -> bytes:
+    """Creates an exception table entry (offsets in bytes)"""
+    return (
+        varint(start // 2, 0x80) + varint((end - start) // 2) + varint(target // 2) + varint(depth << 1 | lasti)
+    )
+
+
+def no_location(length: int) -> bytes:
+    """linetable entries for a number of code units with no location"""
+    entries = b""
+    while length > 0:
+        entries += bytes((0x80 | (15 << 3) | (min(length, 8) - 1),))
+        length -= 8
+    return entries
+
+
+def resume_code(code_obj: CodeType, f_locals: dict, stack: list, lasti: int | None) -> CodeType:
+    """
+    Creates a generator code object that restores the locals and value
+    stack and then jumps to the instruction after the last yield
+
+    Layout:
+     - the POP_TOP + RESUME 0 after RETURN_GENERATOR are replaced with
+       a jump to the resume block (appended to the end of the code)
+     - the resume block restores the locals + value stack, and if it has
+       started, yields once so that values can be sent on resuming
+     - jumps back to the resume point
+    """
+    attrs = {attr: getattr(code_obj, attr) for attr in code_attrs()}
+    co_code, consts = bytearray(attrs["co_code"]), list(attrs["co_consts"])
+    start = co_code.index(bytes((opmap["RETURN_GENERATOR"], 0))) + 2
+    if co_code[start : start + 4] != bytes((opmap["POP_TOP"], 0, opmap["RESUME"], 0)):
+        raise BytecodeError("unexpected generator prologue")
+    ## the resume block ##
+    block = instruction("POP_TOP") + instruction("RESUME")
+    cells = set(code_obj.co_cellvars + code_obj.co_freevars)
+    for index, name in enumerate(localsplus_names(code_obj)):
+        if name in f_locals:
+            block += instruction("LOAD_CONST", len(consts))
+            block += instruction("STORE_DEREF" if name in cells else "STORE_FAST", index)
+            consts += [f_locals[name]]
+    for value in stack:
+        if value is NULL:
+            block += instruction("PUSH_NULL")
+        else:
+            block += instruction("LOAD_CONST", len(consts))
+            consts += [value]
+    if lasti is None:
+        target = start + 4
+    else:
+        ## yields None on the first next so that the sent value is on the stack when resuming ##
+        block += instruction("LOAD_CONST", len(consts))
+        consts += [None]
+        ## exceptions thrown are handled the same as the original yield would ##
+        offset = len(co_code) + len(block)
+        for entry in _parse_exception_table(code_obj):
+            if entry.start <= lasti < entry.end:
+                attrs["co_exceptiontable"] += exception_entry(
+                    offset, offset + 4, entry.target, entry.depth, entry.lasti
+                )
+                break
+        ## the oparg of YIELD_VALUE is the exception depth (used on closing) ##
+        block += instruction("YIELD_VALUE", co_code[lasti + 1]) + instruction("RESUME", 1)
+        target = lasti + 2
+    block += jump("JUMP_BACKWARD", (len(co_code) + len(block) + 4 - target) // 2)
+    ## jump to the resume block ##
+    co_code[start : start + 4] = jump("JUMP_FORWARD", (len(co_code) - start - 4) // 2)
+    attrs.update(
+        {
+            "co_argcount": 0,
+            "co_posonlyargcount": 0,
+            "co_kwonlyargcount": 0,
+            ## remove CO_VARARGS and CO_VARKEYWORDS since the arguments are now locals ##
+            "co_flags": attrs["co_flags"] & ~0x0C,
+            "co_code": bytes(co_code + block),
+            "co_consts": tuple(consts),
+            "co_stacksize": max(attrs["co_stacksize"], len(stack) + 2),
+            "co_linetable": attrs["co_linetable"] + no_location(len(block) // 2),
+        }
+    )
+    return CodeType(*attrs.values())
+
+
+def bytecode_snapshot(self: object) -> None:
+    """
+    Records the code, frame, value stack and f_lasti of a natively run generator
+
+    Note: generators created by bytecode_resume keep the original code object (and
+    their f_lasti is mapped back to it) so that they can be copied/pickled again
+    """
+    ## import here to avoid a circular import ##
+    from gcopy.custom_generator import Generator, code, frame
+
+    FUNC = self._native
+    if isinstance(FUNC, FunctionType):
+        return
+    state = getgeneratorstate(FUNC)
+    if state == GEN_RUNNING:
+        raise BytecodeError("cannot snapshot a running generator")
+    if self._internals.get("resumed"):
+        ## the locals are only restored once it's started so the snapshot is unchanged ##
+        if state == GEN_CREATED:
+            return
+    else:
+        self._internals["code"] = code(getcode(FUNC))
+    if state == GEN_CLOSED:
+        self._internals.update({"frame": None, "stack": [], "lasti": None})
+        return
+    _frame = getframe(FUNC)
+    lasti = None if state == GEN_CREATED else _frame.f_lasti
+    ## the resume code is the original code followed by the resume block where ##
+    ## it can only be suspended at the yield i.e. the same as at the resume point ##
+    if self._internals.get("resumed") and lasti is not None and lasti >= len(self._internals["code"].co_code):
+        lasti = self._internals["lasti"]
+    stack = []
+    for value in value_stack(_frame):
+        ## i.e. yield from generator ##
+        if isinstance(value, GeneratorType):
+            value = Generator(value, "bytecode")
+        stack += [value]
+    self._internals.update(
+        {
+            "frame": frame(_frame),
+            "stack": stack,
+            "lasti": lasti,
+        }
+    )
+
+
+def bytecode_resume(self: object) -> GeneratorType:
+    """Creates the natively run generator from the recorded snapshot"""
+    _frame = self._internals["frame"]
+    if _frame is None:
+        return empty_generator()
+    code_obj = CodeType(*(getattr(self._internals["code"], attr) for attr in code_attrs()))
+    f_locals = _frame.f_locals
+    closure = tuple(CellType(f_locals[name]) if name in f_locals else CellType() for name in code_obj.co_freevars)
+    code_obj = resume_code(code_obj, f_locals, self._internals["stack"], self._internals["lasti"])
+    gen = FunctionType(code_obj, _frame.f_globals, code_obj.co_name, None, closure)()
+    if self._internals["lasti"] is not None:
+        next(gen)
+    self._internals["resumed"] = True
+    return gen
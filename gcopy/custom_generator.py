@@ -1,12 +1,16 @@
 ##################################
 ### picklable/copyable objects ###
 ##################################
+from atexit import register
+from concurrent.futures import Future, ThreadPoolExecutor
 from copy import copy, deepcopy
+from ctypes import c_int, py_object, pythonapi
+from dis import get_instructions
 
 ## needed to access c level memory for the builtin iterators ##
 from functools import partial, wraps
 from inspect import currentframe  # # used in _frame_init
-from inspect import getsource
+from inspect import GEN_CLOSED, GEN_CREATED, GEN_RUNNING, getgeneratorstate
 from sys import exc_info, version_info
 from textwrap import dedent
 from types import CodeType  # , FrameType ## lineno_adjust
@@ -18,20 +22,30 @@ from types import (
     FunctionType,
     GeneratorType,
 )
-from typing import Any
+from typing import Any, Iterable
+from weakref import finalize
 
+from gcopy.ast_unpack import resume_lineno
+from gcopy.bytecode import bytecode_resume, bytecode_snapshot
+from gcopy.bytecode import supported as bytecode_supported
 from gcopy.source_processing import (
     clean_lambda,
     clean_source_lines,
     control_flow_adjust,
     expr_getsource,
+    fast_internals,
     genexpr_adjust,
     get_indent,
     get_loops,
+    live_names,
     loop_adjust,
+    loop_table,
     outer_loop_adjust,
-    sign
+    resume_points,
+    sign,
+    state_names,
 )
+from gcopy.state_machine import StateMachineError, machine_init, machine_next
 from gcopy.track import track_shift
 
 ## to ensure gcopy.custom_generator.Generator can be used in exec for sign ##
@@ -40,11 +54,17 @@ from gcopy.utils import (
     code_attrs,
     copier,
     empty_generator,
+    fast_deepcopy,
     get_globals,
     get_nonlocals,
     getcode,
     getframe,
-    hasattrs
+    getsource,
+    hasattrs,
+    resolve,
+    DiskCache,
+    LRUCache,
+    source_hash,
 )
 
 try:
@@ -59,6 +79,65 @@ if version_info < (3, 5):
     raise ImportError("Python version 3.11 or above is required")
 
 
+## process-wide cache of compiled states shared by all Generator instances ##
+## i.e. state_cache.resize(1024) to change the size limit, state_cache.info() for the counters ##
+state_cache = LRUCache(256)
+
+## process-wide cache of function plans e.g. the processed source of a code object ##
+## (source, source_lines, jump_positions, linetable, loop_table, fingerprint) shared by all instances ##
+## keyed by the hash of the source of the code object, whether it is running, and the unpacker ##
+plan_cache = LRUCache(1024)
+
+## the source hashes of the code objects by the id of their code object; these are keyed by ##
+## identity (like code_cache) since code objects with different sources can compare equal ##
+source_hashes = {}
+
+## persistent cache of function plans stored alongside __pycache__ (written on exit) ##
+## i.e. disk_cache.enabled = True to enable it, and disk_cache_states = True to also ##
+## store the compiled states (as marshalled code objects) ##
+disk_cache = DiskCache()
+disk_cache_states = False
+register(disk_cache.save)
+
+## the locals of the states are bound in bulk if the c api supports it (see bind_locals) ##
+fast_bind = hasattr(pythonapi, "PyFrame_LocalsToFast")
+
+## background thread for compiling the states (i.e. Generator(FUNC, precompile=True)) and ##
+## the precompiling tasks (futures) by the fingerprint, local variable names and version ##
+precompile_pool = ThreadPoolExecutor(1, "gcopy-precompile")
+precompiled = LRUCache(1024)
+
+## the interned code objects (see code) by the id of their code object; these are keyed by ##
+## identity since code objects compare equal regardless of co_filename and co_qualname ##
+## (the entries are removed when their code object is garbage collected) ##
+code_cache = {}
+
+## process-wide cache of the adjusted source of the states (state, linetable, and ##
+## the remaining loops) by the fingerprint and resume point; _create_state is only ##
+## needed once per resume point since it's determined by the function plan ##
+block_cache = LRUCache(1024)
+
+## the names that can still be used from a resume point by the fingerprint and lineno; ##
+## with prune_locals = True the dead locals are dropped on copying and pickling ##
+liveness_cache = LRUCache(1024)
+prune_locals = False
+
+## whether a generator expressions code has a single for clause (see genexpr_snapshot) ##
+genexpr_cache = LRUCache(1024)
+
+## with compact_pickle = True generators of importable functions are pickled with a reference ##
+## ('module:qualname'), the fingerprint and the resume point instead of the function plan ##
+compact_pickle = False
+
+## the parts of a function plan in _internals; these are read-only (they get ##
+## replaced rather than modified) and therefore are shared instead of copied ##
+plan_keys = ("source", "source_lines", "jump_positions", "linetable", "loop_table", "fingerprint")
+
+## the estimated cost of converting to the source engine in native steps per source line ##
+## (the "replay" engine replays copies if they've taken fewer steps than the estimate) ##
+replay_steps_per_line = 150
+
+
 class Pickler:
     """
     class for allowing general copying and pickling of
@@ -69,6 +148,7 @@ class Pickler:
     what attributes get pickled
     """
 
+    __slots__ = ()
     _not_allowed = tuple()
 
     ## for copying ##
@@ -77,7 +157,8 @@ class Pickler:
         return copier(self, copy)
 
     def __deepcopy__(self, memo: dict) -> object:
-        return copier(self, deepcopy)
+        ## one memo is used for all the attributes so that shared references stay shared ##
+        return copier(self, lambda obj: fast_deepcopy(obj, memo), memo)
 
     def copy(self, deep: bool = True) -> object:
         """short hand method for copying"""
@@ -86,14 +167,12 @@ class Pickler:
         return copy(self)
 
     def _pickler_get(obj: object) -> object:
-        """Used on recursive pickling of objects"""
-        if issubclass(type(obj), Pickler):
-            ## we create a copy to avoid affecting the the original Pickler instances attributes ##
-            obj = obj.copy()
-            ## subclasses of Pickler will remove attributes on pickling ##
-            for attr in obj._not_allowed:
-                if hasattr(obj, attr):
-                    delattr(obj, attr)
+        """
+        Used on recursive pickling of objects
+
+        Note: nested Pickler instances are pickled as is (not copied) since
+        their own __getstate__ already leaves out their _not_allowed attributes
+        """
         return obj
 
     ## for pickling ##
@@ -112,14 +191,50 @@ class Pickler:
 
 
 class code(Pickler):
-    """For pickling and copying code objects"""
+    """
+    For pickling and copying code objects
 
-    _attrs = code_attrs()
+    Note: these are treated as immutable e.g. code objects are interned
+    (code(code_obj) is the same instance for the same code_obj) and are
+    shared rather than copied; use the replace method to modify them
+    """
 
-    def __init__(self, code_obj: CodeType = None) -> None:
+    _attrs = code_attrs()
+    __slots__ = _attrs
+
+    def __new__(cls, code_obj: CodeType = None) -> object:
+        if isinstance(code_obj, CodeType):
+            self = code_cache.get(id(code_obj))
+            if self is None:
+                self = code_cache[id(code_obj)] = super().__new__(cls)
+                self._set(code_obj)
+                finalize(code_obj, code_cache.pop, id(code_obj), None)
+            return self
+        self = super().__new__(cls)
         if code_obj:
-            for attr in self._attrs:
-                setattr(self, attr, getattr(code_obj, attr, None))
+            self._set(code_obj)
+        return self
+
+    def _set(self, code_obj: CodeType) -> None:
+        """sets the attributes from a code object"""
+        for attr in self._attrs:
+            setattr(self, attr, getattr(code_obj, attr, None))
+
+    def replace(self, **kwargs) -> object:
+        """returns a new code object with the attributes replaced (like CodeType.replace)"""
+        new = super().__new__(type(self))
+        for attr in self._attrs:
+            if attr in kwargs:
+                setattr(new, attr, kwargs[attr])
+            elif hasattr(self, attr):
+                setattr(new, attr, getattr(self, attr))
+        return new
+
+    def __copy__(self) -> object:
+        return self
+
+    def __deepcopy__(self, memo: dict) -> object:
+        return self
 
     def __bool__(self) -> bool:
         """Used on i.e. if code_obj:"""
@@ -153,6 +268,7 @@ class frame(Pickler):
         "f_trace_opcodes",
     )
     _not_allowed = ("f_globals", "f_builtins")
+    __slots__ = _attrs
 
     def __init__(self, frame: FrameType = None) -> None:
         if frame:
@@ -191,6 +307,36 @@ class frame(Pickler):
         self.f_globals = get_globals()
 
 
+class frame_snapshot(frame):
+    """
+    A lightweight frame for the states (created on every step in _update)
+
+    Only f_locals, f_lineno, f_lasti and f_globals (from the frame rather
+    than get_globals) are recorded, f_back is None, and f_code is wrapped
+    in a code object when it's accessed
+    """
+
+    __slots__ = ("_f_code",)
+
+    def __init__(self, frame: FrameType = None) -> None:
+        if frame is None:
+            super().__init__()
+            return
+        self.f_locals, self.f_lineno, self.f_lasti = frame.f_locals, frame.f_lineno, frame.f_lasti
+        self.f_globals, self.f_back, self._f_code = getattr(frame, "f_globals", None), None, frame.f_code
+
+    @property
+    def f_code(self) -> code:
+        f_code = self._f_code
+        if isinstance(f_code, CodeType):
+            f_code = self._f_code = code(f_code)
+        return f_code
+
+    @f_code.setter
+    def f_code(self, value: code) -> None:
+        self._f_code = value
+
+
 class EOF(StopIteration, StopAsyncIteration):
     """
     Custom exception to exit out of the generator on return statements.
@@ -242,7 +388,65 @@ class BaseGenerator:
     ## __bool__ (or __nonzero__ in python 2.x) attribute ##
     ## so we don't necessarily have to implement one ##
 
-    __copy__, __deepcopy__, copy = Pickler.__copy__, Pickler.__deepcopy__, Pickler.copy
+    def copy(self, deep: bool = True, deferred: bool = False) -> object:
+        """
+        short hand method for copying; deferred deepcopies share the locals with
+        the original and each local is only copied (by either of them) once a
+        state that uses it is run (see _unshare)
+        """
+        engine = self._internals["engine"]
+        if not (deep and deferred) or engine not in ("source", "state_machine") or self._internals["frame"] is None:
+            return Pickler.copy(self, deep)
+        ## the locals it's copied already can't be shared since they're no longer the originals ##
+        if "shared" in self._internals and self._internals["shared"][1]:
+            self._unshare()
+        _frame = self._internals["frame"]
+        ## detach the locals so that only the rest is copied ##
+        f_locals, _frame.f_locals = _frame.f_locals, {}
+        try:
+            obj = deepcopy(self)
+        finally:
+            _frame.f_locals = f_locals
+        ## the names of the locals each instance still shares and its memo for copying them ##
+        self._internals["shared"] = (set(f_locals), {})
+        obj._internals["frame"].f_locals, obj._internals["shared"] = dict(f_locals), (set(f_locals), {})
+        return obj
+
+    def _unshare(self, names: Iterable[str] | None = None) -> None:
+        """
+        copies the given locals (or all of them) that are still shared with other copies (see copy)
+
+        Note: every instance copies the shared locals it uses (even the last one to use
+        them) so that the shared objects are never mutated; they're deepcopied with one
+        memo per instance so that the aliasing between its locals is kept
+        """
+        shared, memo = self._internals["shared"]
+        f_locals = self._internals["frame"].f_locals
+        for name in tuple(shared if names is None else shared.intersection(names)):
+            shared.discard(name)
+            if name in f_locals:
+                f_locals[name] = fast_deepcopy(f_locals[name], memo)
+        if not shared:
+            del self._internals["shared"]
+
+    def __copy__(self) -> object:
+        return self._share(Pickler.__copy__(self))
+
+    def __deepcopy__(self, memo: dict) -> object:
+        return self._share(Pickler.__deepcopy__(self, memo))
+
+    def _share(self, obj: object) -> object:
+        """
+        The compiled state machine and the globals are
+        immutable and therefore shared between copies
+        """
+        if hasattr(self, "_machine"):
+            obj._machine = self._machine
+        elif (self._internals["engine"] == "bytecode" or self._internals.get("genexpr")) and self._internals.get(
+            "frame"
+        ):
+            obj._internals["frame"].f_globals = self._internals["frame"].f_globals
+        return obj
 
     def _api_setup(self) -> None:
         """sets up the api; subclasses should override this method for alternate api setup"""
@@ -255,6 +459,9 @@ class BaseGenerator:
     def __init__(
         self,
         FUNC: FunctionType | GeneratorType | str = None,
+        engine: str = "source",
+        precompile: bool = False,
+        unpacker: str = "scan",
     ) -> None:
         """
         Takes in a function/generator or its source code as the first argument
@@ -262,6 +469,30 @@ class BaseGenerator:
         If FUNC=None it will simply initialize as without any attributes, this
         is for the __setstate__ method in Pickler._copier use case
 
+        engine determines how the generator is emulated:
+         - "source": the source code is adjusted and compiled per state (default)
+         - "state_machine": the generator function is compiled once into a
+           state machine (see gcopy.state_machine); falls back to "source"
+           if the function or generator (if already started) is not supported
+         - "native": the function/generator is run natively and only gets
+           converted to the "source" engine once it's copied or pickled
+         - "bytecode": the same as "native" but copies/unpickled generators
+           resume natively from a snapshot of the frame (CPython 3.12 only)
+         - "replay": the same as "native" but copies/unpickled generators are
+           recreated from the initial arguments and replay the sends/throws
+           if it's estimated to be cheaper than converting to "source" (this
+           assumes the generator is deterministic in its arguments and sends)
+
+        precompile compiles the states of every resume point in the background
+        (for the "source" engine) so that they're not compiled on __next__
+
+        unpacker determines how value yields are unpacked in the source:
+         - "scan": while scanning the source in clean_source_lines (default)
+         - "ast": lifted into statements beforehand via the ast (see gcopy.ast_unpack);
+           falls back to "scan" if the source can't be parsed on its own. Running
+           generators suspended at a yield evaluated after another value yield of
+           the same statement can't be resumed (a ValueError is raised)
+
         Note:
          - gi_running: is the generator currently being executed
          - gi_suspended: is the generator currently paused e.g. state is saved
@@ -271,6 +502,12 @@ class BaseGenerator:
         """
         ## for the api setup ##
         self._api_setup()
+        if unpacker not in ("scan", "ast"):
+            raise ValueError("unpacker must be 'scan' or 'ast' not %r" % unpacker)
+        self._internals["engine"] = engine
+        ## the options are kept for converting the native engines (see _materialize) ##
+        self._internals["unpacker"] = unpacker
+        self._internals["precompile"] = precompile
         ## unused attribute for initialized generator (but will be set to a callable for uninitialized generators) ##
         self.__call__ = Generator_call_error
         ## __setstate__ from Pickler._copier ##
@@ -279,8 +516,14 @@ class BaseGenerator:
 
             ## needed to identify certain attributes ##
             prefix = self._internals["prefix"]
+            if engine in ("native", "bytecode", "replay") and self._native_setup(FUNC):
+                ## nothing else is needed until it gets copied or pickled ##
+                return
+            if engine == "state_machine" and self._machine_setup(FUNC):
+                ## the state machine doesn't need any source processing ##
+                self._internals["resume"] = 0
             ## running generator ##
-            if hasattr(FUNC, prefix + "code"):
+            elif hasattr(FUNC, prefix + "code"):
                 self._internals.update(
                     {
                         "linetable": [],
@@ -305,9 +548,8 @@ class BaseGenerator:
                 elif self._internals["code"].co_name == "<lambda>":
                     clean_lambda(self, FUNC)
                 else:
-                    self._internals["source"] = dedent(getsource(getcode(FUNC)))
                     ## we need to record a linetable for the lineno since the source code gets modified ##
-                    clean_source_lines(self, True)
+                    self._plan(FUNC, True)
                     self._internals["lineno"] = (
                         self._internals["frame"].f_lineno - self._internals["code"].co_firstlineno
                     )
@@ -315,15 +557,13 @@ class BaseGenerator:
                     if self._internals["lineno"] == 0:
                         self._internals["lineno"] = 1
                     else:
-                        self._internals["lineno"] = self._internals["linetable"][self._internals["lineno"]]
-                        #  + lineno_adjust(self._internals["frame"]) ## for compound statements if implementing ##
-                        ## only increase if it's not inside a loop ##
-                        self._internals["lineno"] += 1 - bool(
-                            get_loops(
-                                self._internals["lineno"],
-                                self._internals["jump_positions"],
-                            )
+                        self._internals["lineno"] = resume_lineno(
+                            self._internals["linetable"][self._internals["lineno"]], FUNC
                         )
+                        #  + lineno_adjust(self._internals["frame"]) ## for compound statements if implementing ##
+                        ## the loops are of the yield since the next lineno can be past the end of a loop ##
+                        self._internals["loops"] = self._get_loops(self._internals["lineno"])
+                        self._internals["lineno"] += 1
                     track_shift(FUNC, self._locals().get(".internals", {}))
             ## uninitialized generator ##
             else:
@@ -346,8 +586,7 @@ class BaseGenerator:
                     if FUNC.__code__.co_name == "<lambda>":
                         clean_lambda(self, FUNC)
                     else:
-                        self._internals["source"] = dedent(getsource(FUNC))
-                        clean_source_lines(self)
+                        self._plan(FUNC)
                         track_shift(FUNC, self._locals().get(".internals", {}))
                 else:
                     raise TypeError("type '%s' is an invalid initializer for a Generator" % type(FUNC))
@@ -362,6 +601,8 @@ class BaseGenerator:
                 ## every other instance should require the variables ##
                 ## to exist in the local scope first ##
                 self._locals().update(get_nonlocals(self))
+            if self._internals["engine"] != "source":
+                return
             ## create the states ##
             self._internals["state"] = self._internals["source_lines"]
             self._internals["state_generator"] = self._init_states()
@@ -377,19 +618,180 @@ class BaseGenerator:
                 f_locals[".internals"] = internals
             else:
                 f_locals[".internals"].update(internals)
+            if precompile:
+                self._precompile()
+
+    def _machine_setup(self, FUNC: FunctionType | GeneratorType) -> bool:
+        """
+        Sets up the state machine engine for uninitialized function
+        generators or generators that haven't started yet
+
+        Returns False (and falls back to the source engine) if not supported
+        """
+        prefix = self._internals["prefix"]
+        ## only (synchronous) Generators are supported ##
+        if prefix != "gi_":
+            self._internals["engine"] = "source"
+            return False
+        if isinstance(FUNC, FunctionType):
+            _frame, code_obj = frame(), FUNC.__code__
+            _frame.f_globals = FUNC.__globals__
+        elif hasattr(FUNC, prefix + "code") and getgeneratorstate(FUNC) == GEN_CREATED:
+            _frame, code_obj = frame(getframe(FUNC)), getcode(FUNC)
+        else:
+            self._internals["engine"] = "source"
+            return False
+        self._internals.update(
+            {
+                "code": code(code_obj),
+                "frame": _frame,
+                "suspended": not isinstance(FUNC, FunctionType),
+                "yieldfrom": None,
+                "running": False,
+            }
+        )
+        try:
+            if not code_obj.co_name.isidentifier():
+                raise StateMachineError("only function generators are supported")
+            machine_init(self, code_obj)
+        except StateMachineError:
+            self._internals["engine"] = "source"
+            return False
+        if isinstance(FUNC, FunctionType):
+            self.__name__ = code_obj.co_name
+            self.__defaults__ = FUNC.__defaults__
+            self.__call__ = sign(Generator__call__, FUNC, globals(), True)
+        else:
+            for key in ("code", "frame", "suspended", "yieldfrom", "running"):
+                setattr(self, prefix + key, self._internals[key])
+        return True
+
+    def _native_setup(self, FUNC: FunctionType | GeneratorType) -> bool:
+        """
+        Sets up the native engine for function generators and generators
+
+        Returns False (and falls back to the source engine) if not supported
+        """
+        prefix = self._internals["prefix"]
+        ## only (synchronous) Generators are supported ##
+        if (
+            prefix != "gi_"
+            or not (isinstance(FUNC, FunctionType) or hasattr(FUNC, prefix + "code"))
+            or self._internals["engine"] == "bytecode"
+            and not bytecode_supported
+        ):
+            self._internals["engine"] = "source"
+            return False
+        self._native = FUNC
+        if isinstance(FUNC, FunctionType):
+            self.__name__ = FUNC.__code__.co_name
+            self.__defaults__ = FUNC.__defaults__
+            self.__call__ = Generator_native_call
+        return True
+
+    def _materialize(self) -> None:
+        """
+        Converts a natively run generator into the source engine
+        (i.e. on copying or pickling) from its current state
+        """
+        FUNC = self.__dict__.pop("_native")
+        if hasattr(FUNC, self._internals["prefix"] + "code") and getgeneratorstate(FUNC) == GEN_CLOSED:
+            self._internals["engine"] = "source"
+            self._close()
+            ## an empty state (e.g. EOF) ##
+            self._internals.update(
+                {"code": code(getcode(FUNC)), "lineno": 1, "source_lines": [], "jump_positions": [], "linetable": []}
+            )
+            for key in ("code", "frame", "suspended", "yieldfrom", "running"):
+                setattr(self, self._internals["prefix"] + key, self._internals[key])
+            return
+        self.__init__(FUNC, precompile=self._internals["precompile"], unpacker=self._internals["unpacker"])
+
+    def _replay_limit(self) -> int:
+        """the estimated cost of converting to the source engine in native steps"""
+        linenos = [lineno for *_, lineno in getcode(self._native).co_lines() if lineno is not None]
+        lines = max(linenos, default=0) - min(linenos, default=0) + 1
+        return lines * replay_steps_per_line
+
+    def _replay_cost(self) -> bool:
+        """
+        Cost model for the replay engine; replaying is chosen if the number of steps
+        so far is less than the estimated cost of converting to the source engine
+        """
+        if self._internals.get("log") is None:
+            return False
+        return len(self._internals["log"]) <= self._replay_limit()
+
+    def _replay(self) -> GeneratorType:
+        """
+        recreates the generator and replays its log of sends/throws/closes
+
+        Note: finished generators are recreated as closed generators so any
+        exception raised while replaying means that the replay diverged
+        """
+        args, kwargs = deepcopy(self._internals["args"])
+        gen = self._internals["function"](*args, **kwargs)
+        if self._internals.get("closed"):
+            gen.close()
+            return gen
+        for method, args in self._internals["log"]:
+            try:
+                getattr(gen, method)(*args)
+            except StopIteration:
+                break
+        return gen
+
+    def _record(self, method: str, *args) -> None:
+        """records a send/throw/close for the replay engine"""
+        log = self._internals.get("log")
+        if log is not None:
+            log += [(method, args)]
+            ## copies past the estimate get converted so the log is no longer needed ##
+            if len(log) > self._internals["log_limit"]:
+                self._internals.update({"log": None, "args": None})
+
+    def __getattr__(self, attr: str) -> Any:
+        """the api of natively run generators is forwarded (e.g. gi_frame)"""
+        internals = self.__dict__.get("_internals", {})
+        if internals.get("engine") in ("bytecode", "replay") or internals.get("genexpr"):
+            ## copied/unpickled generators are resumed on first use ##
+            if attr == "_native":
+                if internals.get("genexpr"):
+                    self._native = genexpr_resume(self)
+                elif internals["engine"] == "bytecode":
+                    self._native = bytecode_resume(self)
+                else:
+                    self._native = self._replay()
+                return self._native
+            if attr.startswith(internals["prefix"]):
+                return getattr(self._native, attr)
+        elif "_native" in self.__dict__ and attr.startswith(internals["prefix"]):
+            return getattr(self._native, attr)
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, attr))
 
     def _init_states(self) -> GeneratorType:
-        """Initializes the state generation as a generator"""
-        self._internals["loops"] = get_loops(self._internals["lineno"], self._internals["jump_positions"])
+        """
+        Initializes the state generation as a generator
+
+        Note: yields the resume point (lineno and loops) that
+        the state was created from for caching the compiled states
+        """
+        if "loops" not in self._internals:
+            self._internals["loops"] = self._get_loops(self._internals["lineno"])
         ## if no state then it must be EOF ##
         while self._internals["state"]:
-            yield self._create_state()
+            resume_point = (self._internals["lineno"], tuple(self._internals["loops"]))
+            self._create_state(resume_point)
+            yield resume_point
 
-    def _create_state(self) -> None:
+    def _create_state(self, resume_point: tuple | None = None) -> None:
         """
         creates a section of modified source code to be used in a
         function to act as a generators state
 
+        The states are cached in the block_cache by the fingerprint and
+        resume_point (if given) since they're the same every time
+
         The approach is as follows:
 
         Use the entire source code, reducing from the last lineno.
@@ -406,44 +808,125 @@ class BaseGenerator:
         outermost nesting will be the final section that
         also contains the rest of the source lines as well
         """
+        key = None
+        if resume_point is not None:
+            key = (self._fingerprint(), resume_point)
+            cached = block_cache.get(key)
+            if cached is not None:
+                self._internals["state"], self._internals["linetable"], loops = cached
+                self._internals["loops"] = list(loops)
+                return
+        self._adjust_state()
+        if key is not None:
+            block_cache[key] = (
+                self._internals["state"],
+                self._internals["linetable"],
+                tuple(self._internals["loops"]),
+            )
+
+    def _adjust_state(self) -> None:
+        """adjusts the source lines from the current lineno and loops into the state"""
         ## jump_positions are in linenos but get_loops automatically sets the indexing to 0 based ##
-        loops = self._internals["loops"]
+        loops = list(self._internals["loops"])
         index = self._internals["lineno"] - 1  ## for 0 based indexing ##
+        source_lines = self._internals["source_lines"]
         if loops:
             start_pos, end_pos = loops[-1]
+            end_pos += 1  ## since the jump_positions are inclusion based ##
             ## adjustment ##
-            blocks, indexes = self._internals["source_lines"][index:end_pos], []
+            blocks, indexes = source_lines[index:end_pos], []
             if index < end_pos and blocks:
                 loops.pop()
                 blocks, indexes = control_flow_adjust(
                     blocks,
                     list(range(index, end_pos)),
-                    get_indent(self._internals["source_lines"][start_pos]),
-                )
-                blocks, indexes = loop_adjust(
-                    blocks, indexes, self._internals["source_lines"][start_pos:end_pos], *(start_pos, end_pos)
+                    get_indent(source_lines[start_pos]),
                 )
+                blocks, indexes = loop_adjust(blocks, indexes, source_lines[start_pos:end_pos], *(start_pos, end_pos))
             self._internals["state"], self._internals["linetable"] = outer_loop_adjust(
-                blocks, indexes, self._internals["source_lines"], loops, end_pos
+                blocks, indexes, source_lines, loops, end_pos
             )
             return
         self._internals["state"], self._internals["linetable"] = control_flow_adjust(
-            self._internals["source_lines"][index:],
-            list(range(index, len(self._internals["source_lines"]))),
+            source_lines[index:],
+            list(range(index, len(source_lines))),
         )
 
-    def _locals(self) -> dict:
-        """Short hand method for the current states/frames locals"""
+    def _locals(self, *names: str) -> dict:
+        """
+        Short hand method for the current states/frames locals; the given
+        locals (or all of them if none are given) are copied if they're shared
+        """
+        if "shared" in self._internals:
+            self._unshare(names or None)
         return self._internals["frame"].f_locals
 
+    def _plan(self, FUNC: FunctionType | GeneratorType, running: bool = False) -> None:
+        """
+        Sets the source, source_lines, jump_positions, linetable and loop_table
+        from the function plan of its code object; the source is only processed
+        once per source (hashed once per code object) and all instances reference
+        the same (read-only) plan
+        """
+        unpacker, code_obj, source = self._internals.get("unpacker", "scan"), getcode(FUNC), None
+        digest = source_hashes.get(id(code_obj))
+        if digest is None:
+            source = dedent(getsource(code_obj))
+            digest = source_hashes[id(code_obj)] = source_hash([source])
+            finalize(code_obj, source_hashes.pop, id(code_obj), None)
+        key = (digest, running, unpacker)
+        plan = plan_cache.get(key)
+        if plan is None:
+            disk_key = (plan_keys, code_obj.co_qualname, code_obj.co_firstlineno, running, unpacker)
+            plan = disk_cache.get(code_obj.co_filename, disk_key)
+            if plan is None:
+                self._internals["source"] = source or dedent(getsource(code_obj))
+                clean_source_lines(self, running, unpacker)
+                self._internals["loop_table"] = loop_table(
+                    self._internals["jump_positions"], len(self._internals["source_lines"])
+                )
+                plan = tuple(self._internals[attr] for attr in plan_keys[:-1]) + (self._fingerprint(),)
+                disk_cache.set(code_obj.co_filename, disk_key, plan)
+            plan_cache[key] = plan
+        self._internals.update(zip(plan_keys, plan))
+
+    def _get_loops(self, lineno: int) -> list[tuple[int, int]]:
+        """
+        get_loops via the loop_table of the function plan if it has one
+
+        Note: if modifying the jump_positions manually make sure to remove it
+        """
+        table = self._internals.get("loop_table")
+        if table and lineno < len(table):
+            return list(table[lineno])
+        return get_loops(lineno, self._internals["jump_positions"])
+
+    def _fingerprint(self) -> str:
+        """
+        Fingerprint of the cleaned source used in the state_cache key
+
+        Note: it's recorded in _internals so if modifying the source_lines
+        or jump_positions manually make sure to remove it
+        """
+        if "fingerprint" not in self._internals:
+            self._internals["fingerprint"] = source_hash(
+                self._internals["source_lines"], self._internals["jump_positions"]
+            )
+        return self._internals["fingerprint"]
+
     def _frame_init(self, exception: str = "", sending: bool = False) -> tuple[int, FunctionType]:
         """
         initializes the frame with the current states
         variables but also adjusts the current state
+
+        The compiled states are cached in the state_cache by
+        the cleaned sources fingerprint, the resume point, the
+        exception, and the local variable names (and in the
+        disk_cache if disk_cache_states is set)
         """
         try:
             # set the next state and setup the function; it will raise a StopIteration for us
-            next(self._internals["state_generator"])
+            resume_point = next(self._internals["state_generator"])
         except StopIteration as e:
             self._close()
             raise e
@@ -461,45 +944,126 @@ class BaseGenerator:
                 self._internals["state"] = [" " * temp + "raise " + exception] + self._internals["state"]
                 ## -1 so that on +1 (on _update) it will be correct ##
                 self._internals["linetable"] = [self._internals["linetable"][0] - 1] + self._internals["linetable"]
-        ## initialize the internal locals ##
-        f_locals = self._locals()
+        ## initialize the internal locals (only the shared locals the state uses are copied) ##
+        nonlocals = get_nonlocals(self)
+        names = state_names(self._internals["state"]) if "shared" in self._internals else None
+        f_locals = self._locals() if names is None else self._locals(".internals", *names, *nonlocals)
         if not sending:
             f_locals[".internals"].update({".send": None})
         ## make sure if it has a closure that it's updating the locals (only if it still exists) ##
-        for key, value in get_nonlocals(self).items():
+        for key, value in nonlocals.items():
             if key in f_locals:
                 f_locals[key] = value
+        init_length, self.__source__, code_obj = self._compile_state(
+            resume_point, exception, self._local_names(f_locals)
+        )
+        ## make sure the globals are there ##
+        return init_length, FunctionType(
+            code_obj, self._internals["frame"].f_globals, None, (bind_locals,) if code_obj.co_argcount else None
+        )
+
+    def _local_names(self, f_locals: dict) -> tuple[str, ...]:
+        """
+        The names initialized in the states e.g. the locals of the code
+        object (since these are known ahead of time) and any in f_locals
+        """
+        code_obj = self._internals.get("code")
+        names = set(f_locals)
+        for attr in ("co_varnames", "co_cellvars", "co_freevars"):
+            names.update(getattr(code_obj, attr, None) or ())
+        return tuple(sorted(name for name in names if isinstance(name, str) and name.isidentifier()))
+
+    def _compile_state(
+        self, resume_point: tuple | None, exception: str, names: tuple[str, ...]
+    ) -> tuple[int, list[str], CodeType]:
+        """
+        Compiles the current state returning the preambles length,
+        the source, and the next_state functions code object
+        """
+        key = cached = None
+        if resume_point is not None:
+            key = (self._fingerprint(), resume_point, exception, frozenset(names), self._internals["version"])
+            cached = state_cache.get(key)
+            if cached is None and disk_cache_states:
+                cached = disk_cache.get(self._internals["code"].co_filename, key)
+                if cached is not None:
+                    state_cache[key] = cached
+        if cached is not None:
+            return cached
         ## adjust the initializers ##
         indent = " " * 4
-        init = [
-            self._internals["version"] + "def next_state():",
-            ## get the variables to update the frame
-            indent + "from inspect import currentframe",
-            indent + "frame = currentframe()",
-            indent + "self = frame.f_back.f_locals['self']",
-            indent + "self._locals()['.internals']['.frame'] = frame",
-            indent + "locals().update(self._locals())",
-            indent + "locals()['.internals']['.self'] = self",
-            indent + "del frame, self, currentframe",
-        ]
-        ## make sure variables are initialized ##
-        for key in f_locals:
-            if isinstance(key, str) and key.isidentifier():
-                init += [" " * 4 + "%s=locals()['.internals']['.self']._locals()[%s]" % (key, repr(key))]
+        state = self._internals["state"] + ["    return locals()['.internals']['EOF']()"]
+        if fast_bind:
+            ## the locals are bound in bulk by bind_locals (the default argument); the ##
+            ## names are only assigned (in unreachable code) so that they're fast locals ##
+            init = [
+                self._internals["version"] + "def next_state(__bind__=None):",
+                indent + "__bind__()",
+                indent + "del __bind__",
+                indent + "if 0: " + " = ".join(("__internals__",) + names) + " = None",
+            ]
+            ## '.internals' is also bound to a fast local to avoid calling locals() ##
+            state = fast_internals(state)
+        else:
+            init = [
+                self._internals["version"] + "def next_state():",
+                ## get the variables to update the frame
+                indent + "from inspect import currentframe",
+                indent + "frame = currentframe()",
+                indent + "self = frame.f_back.f_locals['self']",
+                indent + "self._locals()['.internals']['.frame'] = frame",
+                indent + "locals().update(self._locals())",
+                indent + "locals()['.internals']['.self'] = self",
+                indent + "del frame, self, currentframe",
+            ]
+            ## make sure variables are initialized (if they exist; otherwise they're unbound like in the function) ##
+            for name in names:
+                init += [
+                    indent
+                    + (
+                        "if %r in locals()['.internals']['.self']._locals(): "
+                        "%s=locals()['.internals']['.self']._locals()[%r]"
+                    )
+                    % (name, name, name)
+                ]
         ## manual variable initialization needs to be added since updating locals does   ##
         ## not update the frames locals; try not to use variables here (otherwise it can ##
         ## mess with the state); 'return EOF()' is appended to help return after a loop  ##
-        self.__source__ = init + self._internals["state"] + ["    return locals()['.internals']['EOF']()"]
+        source = init + state
         ## we need to give the original filename before using exec for the code_context to ##
         ## be correct in track_iter therefore we compile first to provide a filename then exec ##
-        code_obj = compile("\n".join(self.__source__), "<Generator>", "exec")
-        ## make sure the globals are there ##
-        exec(code_obj, self._internals["frame"].f_globals, locals())
-        return len(init), locals()["next_state"]
+        code_obj = compile("\n".join(source), "<Generator>", "exec")
+        ## the function's code object is the only code object in the module's constants ##
+        for code_obj in code_obj.co_consts:
+            if isinstance(code_obj, CodeType):
+                break
+        cached = (len(init), source, code_obj)
+        if key is not None:
+            state_cache[key] = cached
+            if disk_cache_states:
+                disk_cache.set(self._internals["code"].co_filename, key, cached)
+        return cached
+
+    def _precompile(self) -> Future:
+        """
+        Compiles the states of every resume point in the background
+        (on the precompile_pool) so that they're in the state_cache
+        before they're needed; returns the future of the task
+        """
+        names = self._local_names(self._locals())
+        key = (self._fingerprint(), names, self._internals["version"])
+        future = precompiled.get(key)
+        if future is None:
+            ## the task has its own instance since the state is modified when creating them ##
+            gen = type(self)()
+            for attr in plan_keys + ("version", "code"):
+                gen._internals[attr] = self._internals[attr]
+            future = precompiled[key] = precompile_pool.submit(precompile_states, gen, names)
+        return future
 
     def _update(self, init_length: int) -> None:
         """Update the line position and frame"""
-        _frame = self._internals["frame"] = frame(self._locals()[".internals"][".frame"])
+        _frame = self._internals["frame"] = frame_snapshot(self._locals(".internals")[".internals"][".frame"])
 
         #### update f_locals ####
 
@@ -509,8 +1073,8 @@ class BaseGenerator:
             f_locals[".internals"].pop(".send", None)
             f_locals[".internals"].pop(".frame", None)
             f_locals[".internals"].pop(".self", None)
+        f_locals.pop("__internals__", None)
 
-        _frame.f_back = None
         if ".yieldfrom" in _frame.f_locals[".internals"]:
             self._internals["yieldfrom"] = _frame.f_locals[".internals"][".yieldfrom"]
 
@@ -527,7 +1091,7 @@ class BaseGenerator:
         else:
             ## update the lineno ##
             self._internals["lineno"] = self._internals["linetable"][adjusted_lineno] + 1
-            loops = self._internals["loops"] = get_loops(self._internals["lineno"], self._internals["jump_positions"])
+            loops = self._internals["loops"] = self._get_loops(self._internals["lineno"])
             if not loops:
                 ## if we can advance the lineno then advance it ##
                 ## else (since not in loop) EOF ##
@@ -537,8 +1101,8 @@ class BaseGenerator:
                     ## EOF ##
                     self._internals["state"] = None
                     self._internals["lineno"] = len(self._internals["source_lines"])
-            ## if inside a loop and we can advance the lineno then advance it ##
-            elif self._internals["lineno"] < loops[-1][1]:
+            ## if inside a loop then advance it (past the end of the loop restarts the loop) ##
+            else:
                 self._internals["lineno"] += 1
 
     def _close(self) -> None:
@@ -579,22 +1143,112 @@ class BaseGenerator:
 
     def __getstate__(self, FUNC: FunctionType = Pickler._pickler_get) -> dict:
         """Similar to the __getstate__ method of Pickler but pertaining to self._internals"""
-        dct = dict()
+        ## the shared locals can reference the originals of the copied ones (see copy) ##
+        if "shared" in self._internals and self._internals["shared"][1]:
+            self._unshare()
+        if "_native" in self.__dict__:
+            if self._internals["engine"] == "bytecode" and not isinstance(self._native, FunctionType):
+                bytecode_snapshot(self)
+            elif self._internals["engine"] == "replay" and self._replay_cost():
+                ## finished generators are replayed as closed generators ##
+                self._internals["closed"] = getgeneratorstate(self._native) == GEN_CLOSED
+            elif not genexpr_snapshot(self):
+                self._materialize()
+        dct, dead = dict(), self._dead_locals() if prune_locals else ()
+        reference = compact_pickle and FUNC is Pickler._pickler_get and self._reference()
+        if reference:
+            ## the plan and the code are rebuilt and the state is recreated on unpickling ##
+            dct.update({"reference": reference, "state": bool(self._internals["state"])})
         for key, value in self._internals.items():
-            if key != "state_generator":
+            if reference and (key in plan_keys and key != "linetable" or key in ("code", "state")):
+                continue
+            if key in plan_keys:
+                dct[key] = value
+            elif key == "frame" and value and (dead or reference):
+                ## a shallow copy so that the original frame isn't modified ##
+                value = copy(value)
+                if dead:
+                    value.f_locals = {name: value.f_locals[name] for name in value.f_locals if name not in dead}
+                if reference:
+                    ## the states code object is replaced with the generators code on unpickling ##
+                    value.f_code = None
+                dct[key] = FUNC(value)
+            elif key not in ("state_generator", "shared"):
                 dct[key] = FUNC(value)
         dct = {"_internals": dct}
         for attr in ("__name__", "__defaults__"):
             dct[attr] = getattr(self, attr, None)
         return dct
 
+    def _reference(self) -> tuple[str, str, bool] | None:
+        """
+        The reference ('module:qualname'), fingerprint and whether the plan is for a running
+        generator if the generator function can be imported (and is the same function)
+        """
+        _frame, _code = self._internals.get("frame"), self._internals.get("code")
+        if self._internals["engine"] != "source" or not _frame or "fingerprint" not in self._internals:
+            return None
+        module = (getattr(_frame, "f_globals", None) or {}).get("__name__")
+        if module is None:
+            return None
+        reference = "%s:%s" % (module, _code.co_qualname)
+        try:
+            FUNC = resolve(reference)
+        except (AttributeError, ImportError):
+            return None
+        if not isinstance(FUNC, FunctionType) or code(FUNC.__code__) is not _code:
+            return None
+        for running in (False, True):
+            gen = type(self)(unpacker=self._internals.get("unpacker", "scan"))
+            gen._plan(FUNC, running)
+            if gen._internals["fingerprint"] == self._internals["fingerprint"]:
+                return reference, self._internals["fingerprint"], running
+        return None
+
+    def _restore(self, reference: str, fingerprint: str, running: bool) -> None:
+        """Rebuilds the function plan and code of a compact pickle (see _reference)"""
+        FUNC, linetable = resolve(reference), self._internals["linetable"]
+        self._plan(FUNC, running)
+        if self._internals["fingerprint"] != fingerprint:
+            raise ValueError("the source of '%s' has changed since it was pickled" % reference)
+        self._internals.update({"code": code(FUNC.__code__), "linetable": linetable})
+        _frame = self._internals["frame"]
+        if _frame:
+            _frame.f_code, _frame.f_globals = self._internals["code"], FUNC.__globals__
+
+    def _dead_locals(self) -> set[str]:
+        """
+        The local variables that are no longer used from the current resume point
+        (closure variables are always kept since they can be used by other functions)
+        """
+        if self._internals["engine"] != "source" or not self._internals.get("source_lines"):
+            return set()
+        _frame, lineno = self._internals.get("frame"), self._internals["lineno"]
+        if not _frame:
+            return set()
+        loops = tuple(self._internals.get("loops", ()))
+        key = (self._fingerprint(), lineno, loops)
+        live = liveness_cache.get(key, False)
+        if live is False:
+            live = liveness_cache[key] = live_names(self._internals["source_lines"], lineno, loops)
+        if live is None:
+            return set()
+        _code = self._internals["code"]
+        keep = live.union(getattr(_code, "co_cellvars", ()), getattr(_code, "co_freevars", ()))
+        return {name for name in _frame.f_locals if name.isidentifier() and name not in keep}
+
     def __setstate__(self, state: dict) -> None:
         """
         Unpickles the generator then sets up the api and the state
         """
         self.__name__ = state.pop("__name__", None)
         self.__defaults__ = state.pop("__defaults__", None)
+        reference = state["_internals"].pop("reference", None)
         Pickler.__setstate__(self, state)
+        if reference:
+            self._restore(*reference)
+        if self._internals["engine"] in ("bytecode", "replay") or self._internals.get("genexpr"):
+            return
         ## setup the state api + generator ##
         prefix = self._internals["prefix"]
         for key in ("code", "frame", "suspended", "yieldfrom", "running"):
@@ -626,10 +1280,13 @@ class BaseGenerator:
                 FUNC.__defaults__,
                 closure[:index] + closure[index + 1 :],
             )
-            GEN_FUNC = type(self)(FUNC)
+            GEN_FUNC = type(self)(FUNC, self._internals["engine"], unpacker=self._internals.get("unpacker", "scan"))
             ## you need to add itself to the closure; importantly, its __call__ method ##
             GEN_FUNC.__closure__ += (CellType(GEN_FUNC.__call__),)
-            GEN_FUNC._internals["code"].co_freevars += (FUNC.__name__,)
+            ## (code objects are shared so it's replaced rather than modified) ##
+            _code = GEN_FUNC._internals["code"]
+            _code = _code.replace(co_freevars=_code.co_freevars + (FUNC.__name__,))
+            GEN_FUNC._internals["code"] = GEN_FUNC.__code__ = _code
             ## initialize its locals since this is an uninitialized generator ##
             GEN_FUNC._locals()[FUNC.__name__] = GEN_FUNC.__call__
             ## replace the function with the Generator version ##
@@ -665,6 +1322,108 @@ def Generator__call__(self, *args, **kwargs) -> GeneratorType:
     return self_copy
 
 
+def bind_locals() -> None:
+    """
+    Binds the generators locals to the calling next_state functions
+    locals in bulk (it's the default argument of next_state)
+
+    Note: the fast locals that aren't in the generators locals are left
+    unbound (like they would be in the function) since they're unbound
+    when next_state starts (except __bind__ which next_state deletes)
+    """
+    _frame = currentframe().f_back
+    self = _frame.f_back.f_locals["self"]
+    ## the shared locals the state uses are already copied (in _frame_init) ##
+    f_locals = self._internals["frame"].f_locals
+    f_locals[".internals"].update({".frame": _frame, ".self": self})
+    frame_locals = _frame.f_locals
+    frame_locals.clear()
+    frame_locals.update(f_locals)
+    frame_locals["__internals__"] = f_locals[".internals"]
+    pythonapi.PyFrame_LocalsToFast(py_object(_frame), c_int(0))
+
+
+def precompile_states(self, names: tuple[str, ...]) -> None:
+    """Compiles the states of every resume point (run on the precompile_pool)"""
+    for lineno, loops in resume_points(self._internals["source_lines"], self._internals["jump_positions"]):
+        self._internals.update({"lineno": lineno, "loops": list(loops)})
+        ## it's only an optimization so any states that can't be created are left to __next__ ##
+        try:
+            self._create_state((lineno, loops))
+            if self._internals["state"]:
+                self._compile_state((lineno, loops), "", names)
+        except Exception:
+            pass
+
+
+def Generator_native_call(self, *args, **kwargs) -> GeneratorType:
+    """initializes natively run generators from uninitialized Function generators"""
+    options = {key: self._internals[key] for key in ("engine", "precompile", "unpacker")}
+    gen = type(self)(self._native(*args, **kwargs), **options)
+    if gen._internals["engine"] == "replay":
+        ## the arguments are copied so that mutating them after the call doesn't change the replay ##
+        try:
+            gen._internals.update(
+                {
+                    "function": self._native,
+                    "args": deepcopy((args, kwargs)),
+                    "log": [],
+                    "log_limit": gen._replay_limit(),
+                }
+            )
+        except Exception:
+            ## arguments that can't be copied can't be replayed (copies get converted) ##
+            gen._internals.update({"function": self._native, "args": None, "log": None})
+    return gen
+
+
+def genexpr_snapshot(self) -> bool:
+    """
+    Records the code, globals and a clone of the driving iterator ('.0') of a natively run
+    generator expression with a single for clause (its loop variables are reassigned when
+    it's resumed so this is its whole state); returns False if it's not supported
+    """
+    FUNC = self._native
+    if isinstance(FUNC, FunctionType) or getcode(FUNC).co_name != "<genexpr>":
+        return False
+    _code = getcode(FUNC)
+    single_for = genexpr_cache.get(_code)
+    if single_for is None:
+        single_for = sum(instruction.opname == "FOR_ITER" for instruction in get_instructions(_code)) == 1
+        genexpr_cache[_code] = single_for
+    if not single_for:
+        return False
+    state = getgeneratorstate(FUNC)
+    if state == GEN_RUNNING:
+        return False
+    if state == GEN_CLOSED:
+        self._internals.update({"code": code(_code), "frame": None, "genexpr": True})
+        return True
+    _frame = getframe(FUNC)
+    f_locals = _frame.f_locals
+    ## iterators are cloned via __reduce__ (i.e. generators can't be) ##
+    try:
+        iterator = copy(f_locals[".0"])
+    except (KeyError, TypeError):
+        return False
+    snapshot = frame(_frame)
+    snapshot.f_locals = {name: f_locals[name] for name in _code.co_freevars if name in f_locals}
+    snapshot.f_locals[".0"] = iterator
+    self._internals.update({"code": code(_code), "frame": snapshot, "genexpr": True})
+    return True
+
+
+def genexpr_resume(self) -> GeneratorType:
+    """Creates the natively run generator expression from the recorded snapshot"""
+    _frame = self._internals["frame"]
+    if _frame is None:
+        return empty_generator()
+    code_obj = CodeType(*(getattr(self._internals["code"], attr) for attr in code_attrs()))
+    f_locals = _frame.f_locals
+    closure = tuple(CellType(f_locals[name]) if name in f_locals else CellType() for name in code_obj.co_freevars)
+    return FunctionType(code_obj, _frame.f_globals, code_obj.co_name, None, closure)(f_locals[".0"])
+
+
 def Generator_call_error(*args, **kwargs) -> NoReturn:
     """Error for when an initialized generator is called"""
     raise TypeError("Initialized generators cannot be called, only uninitialized Function generators may be called")
@@ -693,6 +1452,13 @@ class Generator(BaseGenerator):
 
     def __next__(self, exception: str = "", sending: bool = False) -> Any:
         """updates the current state and returns the result"""
+        if self._internals["engine"] in ("native", "bytecode", "replay"):
+            ## resume before recording (copies are resumed on first use) ##
+            native = self._native
+            self._record("send", None)
+            return next(native)
+        if self._internals["engine"] == "state_machine":
+            return machine_next(self, exception)
         ## update with the new state and get the frame ##
         init_length, next_state = self._frame_init(exception, sending)
         try:
@@ -714,9 +1480,16 @@ class Generator(BaseGenerator):
         Send takes exactly one argument 'arg' that
         is sent to the functions yield variable
         """
+        if self._internals["engine"] in ("native", "bytecode", "replay"):
+            ## resume before recording (copies are resumed on first use) ##
+            native = self._native
+            self._record("send", arg)
+            return native.send(arg)
+        if self._internals["engine"] == "state_machine":
+            return machine_next(self, sent=arg)
         if arg is not None and self._internals["lineno"] == 1:
             raise TypeError("can't send non-None value to a just-started generator")
-        self._locals()[".internals"][".send"] = arg
+        self._locals(".internals")[".internals"][".send"] = arg
         return self.__next__(sending=True)
 
     def close(self) -> None:
@@ -727,6 +1500,11 @@ class Generator(BaseGenerator):
         return = return
         yield  = return 1
         """
+        if self._internals["engine"] in ("native", "bytecode", "replay"):
+            ## resume before recording (copies are resumed on first use) ##
+            native = self._native
+            self._record("close")
+            return native.close()
         try:
             if self.__next__("GeneratorExit()"):
                 raise RuntimeError("generator ignored GeneratorExit")
@@ -741,6 +1519,11 @@ class Generator(BaseGenerator):
         Raises an exception from the last line in the
         current state e.g. only from what has been
         """
+        if self._internals["engine"] in ("native", "bytecode", "replay"):
+            ## resume before recording (copies are resumed on first use) ##
+            native = self._native
+            self._record("throw", exception)
+            return native.throw(exception)
         if issubclass(exception, BaseException):
             if isinstance(exception, type):
                 exception = exception.__name__
@@ -798,7 +1581,7 @@ class AsyncGenerator(BaseGenerator):
         """
         if arg is not None and self._internals["lineno"] == 1:
             raise TypeError("can't send non-None value to a just-started generator")
-        self._locals()[".internals"][".send"] = arg
+        self._locals(".internals")[".internals"][".send"] = arg
         return await self.__anext__(sending=True)
 
     async def aclose(self) -> CoroutineType:
@@ -3,31 +3,44 @@
 #################################################
 
 ## needed to access c level memory for the builtin iterators ##
+import ast
+from collections import deque
 from functools import partial, wraps
-from inspect import currentframe, findsource, getsource, signature
-from itertools import chain
+from inspect import currentframe, signature
+from itertools import chain, islice
+from re import compile as re_compile
 from sys import version_info
+from tokenize import TokenError, generate_tokens
 from types import CodeType  # , FrameType ## lineno_adjust
 from types import CellType, FrameType, FunctionType, GeneratorType
 from typing import Any, Callable, Iterable, Iterator
 
+from gcopy.ast_unpack import emit_source
+
 ## to ensure gcopy.custom_generator.Generator can be used in exec for sign ##
 from gcopy.track import get_indent, track_adjust
 from gcopy.utils import (
+    LRUCache,
     attr_cmp,
     cli_findsource,
     code_attrs,
     code_cmp,
     empty_generator,
+    findsource,
     get_nonlocals,
     getcode,
     getframe,
+    getsource,
     is_cli,
     is_running,
     skip,
+    source_index,
     try_set,
 )
 
+## the compiled sources of signed functions keyed by the code object and signature ##
+sign_cache = LRUCache(256)
+
 
 def update_depth(depth: int, char: str, selection: tuple[str, str] = ("(", ")")) -> int:
     """Updates the depth of brackets"""
@@ -1398,25 +1411,32 @@ def loop_adjust(
     to finish the current loop
     """
     ## flag determines if we need to complete a sliced loop or simply dedent its complete form ##
-    new_lines, flag, line_iter = [], False, enumerate(lines)
-    for index, line in line_iter:
+    new_lines, flag, block_indent, inserted = [], False, None, 0
+    for index, line in enumerate(lines):
+        indent = get_indent(line)
+        temp_line = line[indent:]
         ## skip over for/while and definition blocks ##
         ## since these are complete blocks of their own ##
         ## and don't need to be adjusted ##
-        new_lines, temp_line, index = skip_blocks(new_lines, line_iter, index, line)
-        if index is None:
+        if block_indent is not None and indent > block_indent:
+            new_lines += [line]
             continue
-        ## adjustments ##
-        if is_statement(temp_line, "continue"):
+        block_indent = None
+        if is_loop(temp_line) or is_definition(temp_line):
+            block_indent = indent
+            new_lines += [line]
+        ## adjustments (retaining the indentation e.g. for 'if ...: break') ##
+        elif is_statement(temp_line, "continue"):
             flag = True
-            new_lines += ["break"]
+            new_lines += [" " * indent + "break"]
         elif is_statement(temp_line, "break"):
             flag = True
-            new_lines += ["locals()['.internals']['.continue']=False", "break"]
+            new_lines += [" " * indent + "locals()['.internals']['.continue']=False", " " * indent + "break"]
             ## the index can be None since the line should run without errors ##
-            indexes = indexes[:index] + [None] + indexes[index:]
+            indexes = indexes[: index + inserted] + [None] + indexes[index + inserted :]
+            inserted += 1
         else:
-            new_lines += [temp_line]
+            new_lines += [line]
     ## adjust the outer loops iterator in case it's an iterator that needs its tracked version ##
     temp_line = outer_loop[0]
     number_of_indents = get_indent(temp_line)
@@ -1468,6 +1488,37 @@ def yield_adjust(temp_line: str, indent: str) -> list[str]:
         return [indent + "return" + temp_line[5:]]  ## 5 to retain the whitespace ##
 
 
+## the tokens of locals()['.internals'] (see fast_internals) ##
+INTERNALS_TOKENS = ("locals", "(", ")", "[", "'.internals'", "]")
+
+
+def fast_internals(lines: list[str], name: str = "__internals__") -> list[str]:
+    """
+    Replaces locals()['.internals'] with name (a fast local bound to it)
+
+    The lines are tokenized so that strings and comments containing
+    it are left as is; the lines are returned as they are if they
+    can't be tokenized (locals()['.internals'] still works)
+    """
+    if not any("locals()['.internals']" in line for line in lines):
+        return lines
+    spans, window = {}, deque(maxlen=len(INTERNALS_TOKENS))
+    try:
+        for token in generate_tokens(iter([line + "\n" for line in lines]).__next__):
+            window.append(token)
+            if tuple(token.string for token in window) == INTERNALS_TOKENS and window[0].start[0] == token.end[0]:
+                spans.setdefault(token.end[0] - 1, []).append((window[0].start[1], token.end[1]))
+    except (TokenError, SyntaxError):
+        return lines
+    new_lines = lines.copy()
+    for index, line_spans in spans.items():
+        line = new_lines[index]
+        for start, end in reversed(line_spans):
+            line = line[:start] + name + line[end:]
+        new_lines[index] = line
+    return new_lines
+
+
 def get_loops(lineno: int, jump_positions: list[tuple[int, int]]) -> list[tuple[int, int]]:
     """
     returns a list of tuples (start_lineno,end_lineno) for the loop
@@ -1491,6 +1542,82 @@ def get_loops(lineno: int, jump_positions: list[tuple[int, int]]) -> list[tuple[
     return loops
 
 
+def loop_table(jump_positions: list[list[int]], length: int) -> tuple[tuple[tuple[int, int], ...], ...]:
+    """
+    returns the result of get_loops for every lineno (up to length)
+    so that getting the loops of a lineno is an index (O(1)) rather
+    than a scan over all the jump_positions (O(loops))
+    """
+    table = [[] for _ in range(length + 1)]
+    ## the jump positions are ordered so the outer loops are added first ##
+    for start, end in jump_positions:
+        for lineno in range(start + 1, min(end, length) + 1):
+            table[lineno] += [(start - 1, end - 1)]
+    return tuple(map(tuple, table))
+
+
+## the returns of return statements (the latter from gcopy.ast_unpack.emit_source) ##
+EOF_RETURNS = ("return EOF(", "return locals()['.internals']['EOF'](")
+
+
+def resume_points(source_lines: list[str], jump_positions: list[list[int]]) -> list[tuple[int, tuple]]:
+    """
+    returns the resume points (lineno and loops) that the states are
+    created from e.g. the start and after every value yield (these are
+    'return ...' in the cleaned source whereas returns raise EOF)
+    """
+    points, end_lineno = [(1, tuple(get_loops(1, jump_positions)))], len(source_lines)
+    for lineno, line in enumerate(source_lines, start=1):
+        line = line.strip()
+        if not (line == "return" or line.startswith("return ")) or line.startswith(EOF_RETURNS):
+            continue
+        ## the same as the lineno adjustment in Generator._update ##
+        loops = get_loops(lineno, jump_positions)
+        if loops:
+            points += [(lineno + 1, tuple(loops))]
+        elif lineno < end_lineno:
+            points += [(lineno + 1, ())]
+    return points
+
+
+## accessing the locals dynamically means any of them can be used ##
+dynamic_names = frozenset(("locals", "vars", "eval", "exec", "dir"))
+## the identifiers and the generators own locals()['.internals'] accesses ##
+identifier = re_compile(r"[^\W\d]\w*")
+internal_access = re_compile(r"locals\(\)\[(?=['\"]\.)")
+
+
+def live_names(source_lines: list[str], lineno: int, loops: Iterable[tuple[int, int]]) -> frozenset[str] | None:
+    """
+    returns the names that can still be used from a resume point (e.g. in the
+    remaining lines and the encapsulating loops) or None if the locals are
+    accessed dynamically i.e. via locals(), vars(), eval or exec
+
+    Note: every identifier counts as a use (including attributes and names in
+    strings) so this over approximates; names not in it are definitely dead
+    """
+    start = min([lineno - 1] + [loop[0] for loop in loops])
+    names = set()
+    for line in source_lines[start:]:
+        names.update(identifier.findall(internal_access.sub("", line)))
+    if names & dynamic_names:
+        return None
+    return frozenset(names)
+
+
+def state_names(state: list[str]) -> frozenset[str] | None:
+    """
+    returns the names that a state can use before it returns (e.g. up to its
+    first 'return ...' outside of any block) or None if the locals are accessed
+    dynamically; the lines after it can't be reached until the next state
+    """
+    end = 0
+    for end, line in enumerate(state, start=1):
+        if line == "    return" or line.startswith("    return "):
+            break
+    return live_names(state[:end], 1, ())
+
+
 def extract_source_from_comparison(
     code_obj: CodeType,
     source: str,
@@ -1552,6 +1679,65 @@ def extract_source_from_comparison(
     raise Exception("No matches to the original source code found")
 
 
+def node_source(node: ast.AST, lines: list[str], whole_lines: bool = False) -> str:
+    """The source of a node (the col offsets are utf-8 based)"""
+    source = "".join(lines[node.lineno - 1 : node.end_lineno])
+    if whole_lines:
+        return source
+    end_col_offset = len(lines[node.end_lineno - 1].encode()) - node.end_col_offset
+    source = source.encode()[node.col_offset : len(source.encode()) - end_col_offset]
+    return source.decode()
+
+
+def positions_span(node: ast.AST) -> tuple[tuple[int, int], tuple[int, int]]:
+    """The span the co_positions of a lambda (only its body) or genexpr (all of it) are in"""
+    if isinstance(node, ast.Lambda):
+        node = node.body
+    return (node.lineno, node.col_offset), (node.end_lineno, node.end_col_offset)
+
+
+def locate_source(code_obj: CodeType) -> str | None:
+    """
+    Locates the source of a function, lambda or genexpr via its
+    co_firstlineno and co_positions in the source index of its file
+
+    Returns None if it can't be located or there's more than one
+    match (i.e. the positions are ambiguous or not available)
+    """
+    index = source_index(code_obj.co_filename)
+    try:
+        nodes = index.nodes.get(code_obj.co_firstlineno, ()) if index else ()
+    except SyntaxError:
+        return None
+    name = code_obj.co_name
+    if name == "<lambda>":
+        nodes = [node for node in nodes if isinstance(node, ast.Lambda)]
+    elif name == "<genexpr>":
+        nodes = [node for node in nodes if isinstance(node, ast.GeneratorExp)]
+    else:
+        node = index and index.function(code_obj)
+        ## the source starts from the definition (not the decorators) ##
+        if node:
+            return node_source(node, index.lines, True)
+        return None
+    if len(nodes) > 1 and hasattr(code_obj, "co_positions"):
+        positions = [
+            position
+            for position in code_obj.co_positions()
+            if None not in position and position[:3:2] != position[1::2]
+        ]
+        if positions:
+            start = min((position[0], position[2]) for position in positions)
+            end = max((position[1], position[3]) for position in positions)
+            nodes = [node for node in nodes if positions_span(node)[0] <= start and end <= positions_span(node)[1]]
+            ## the innermost node ##
+            if nodes:
+                nodes = [max(nodes, key=lambda node: (node.lineno, node.col_offset))]
+    if len(nodes) == 1:
+        return node_source(nodes[0], index.lines)
+    return None
+
+
 def expr_getsource(FUNC: Any) -> str:
     """
     Uses the source code extracting expressions until a
@@ -1568,6 +1754,11 @@ def expr_getsource(FUNC: Any) -> str:
     code_obj = getcode(FUNC)
     name = code_obj.co_name
     mode = "eval"
+    ## jump straight to its source if possible, otherwise compare with every candidate ##
+    if not is_cli():
+        source = locate_source(code_obj)
+        if source is not None:
+            return source
     if name == "<lambda>":
         ## here source is a : str
         if is_cli():
@@ -1792,22 +1983,33 @@ def outer_loop_adjust(
     indexes: list[int],
     source_lines: list[str],
     loops: list[tuple[int, int]],
-    end_pos: int,  ## in case no loops
+    end_pos: int,  ## the end of the lines already in the block (in case no loops) ##
 ) -> tuple[list[str], list[int]]:
-    """Adds all the outer loops with the iterable adjusted to the current block and its indexes"""
+    """
+    Adds all the outer loops with the iterable adjusted to the current block and its indexes
+
+    Note: the rest of an outer loops body after the loop it encapsulates
+    is added before the outer loop (since it runs before its next iteration)
+    """
     ## add all the outer loops ##
-    for start_pos, end_pos in loops[::-1]:
-        end_pos += 1  ## since the jump_positions are inclusion based ##
-        block = source_lines[start_pos:end_pos]
-        if block:
-            temp_line = block[0]
+    for start_pos, loop_end in loops[::-1]:
+        loop_end += 1  ## since the jump_positions are inclusion based ##
+        outer_loop = source_lines[start_pos:loop_end]
+        rest = source_lines[end_pos:loop_end]
+        if rest:
+            rest, rest_indexes = control_flow_adjust(
+                rest, list(range(end_pos, loop_end)), get_indent(source_lines[start_pos])
+            )
+            rest, rest_indexes = loop_adjust(rest, rest_indexes, outer_loop, start_pos, loop_end)
+        else:
+            temp_line = outer_loop[0]
             number_of_indents = get_indent(temp_line)
             if temp_line[number_of_indents:].startswith("for "):
-                block[0] = iter_adjust(temp_line, number_of_indents)
-        blocks += indent_lines(block, 4 - number_of_indents)
-        ## we need to add 1 to the end position since it's 0 based ( e.g. to be inclusive) ##
-        indexes += list(range(start_pos, end_pos))
-    return blocks + source_lines[end_pos:], indexes
+                outer_loop[0] = iter_adjust(temp_line, number_of_indents)
+            rest, rest_indexes = indent_lines(outer_loop, 4 - number_of_indents), list(range(start_pos, loop_end))
+        blocks, indexes, end_pos = blocks + rest, indexes + rest_indexes, loop_end
+    ## the rest of the source lines after the loops ##
+    return blocks + source_lines[end_pos:], indexes + list(range(end_pos, len(source_lines)))
 
 
 def setup_next_line(self, char: str = " ", indentation: int = None) -> None:
@@ -1901,10 +2103,14 @@ def sign(
     if boundmethod:
         _signature = "(self, " + _signature[1:]
     _signature = FUNC2.__name__ + _signature + ":"
-    source = skip_source_definition(getsource(FUNC))
+    key = (FUNC.__code__, _signature)
+    cached = sign_cache.get(key)
+    if cached is None:
+        source = "def %s%s" % (_signature, skip_source_definition(getsource(FUNC)))
+        cached = sign_cache[key] = (source, compile(source, "<string>", "exec"))
+    source, code_obj = cached
     ## create the function ##
-    source = "def %s%s" % (_signature, source)
-    exec(source, globals, locals(), closure=closure)
+    exec(code_obj, globals, locals(), closure=closure)
     temp = locals()[FUNC2.__name__]
     temp.__source__ = source
     temp.__doc__ = FUNC2.__doc__
@@ -1943,8 +2149,8 @@ def custom_adjustment(self: object, line: str, number_of_indents: int = 0) -> li
     result = yield_adjust(temp_line, indent)
     if temp_line.startswith("yield from "):
         lineno = self.lineno
-        ## lineno + 1 since this is not a loop ##
-        self.jump_positions += [[lineno + 1, lineno + len(result)]]
+        ## lineno + 1 since the assignment is not part of the loop ##
+        self.jump_positions += [[lineno + 1, lineno + len(result) - 1]]
     if result is not None:
         return result
     ## loops ##
@@ -2204,12 +2410,46 @@ def update_stack(self, reference_indent: int = 0) -> None:
         self.linetable += [self.lineno]
 
 
-def clean_source_lines(gen: object, running: bool = False) -> None:
+## Note: the scanner is kept rather than replaced by a tokenize pass since the adjustments ##
+## (unpacking, string collection, ternaries, ';' and ':' splitting and the linetable) are ##
+## interleaved with its per char state, which a token stream would have to rebuild; the  ##
+## quadratic part was growing the line, which LineParts and plain_chars make linear (see ##
+## tests/benchmark_source_processing.py), and unpacker="ast" is the parser based cleaner ##
+class LineParts:
+    """
+    The mutable instance of clean_source_lines; the current line is kept as
+    a list of parts that's only joined when it's read since appending to a
+    string attribute copies the string (making building a line char by char
+    quadratic in its length) whereas appending to the parts is linear
+    """
+
+    @property
+    def line(self) -> str:
+        if len(self.parts) != 1:
+            self.parts = ["".join(self.parts)]
+        return self.parts[0]
+
+    @line.setter
+    def line(self, value: str) -> None:
+        self.parts = [value]
+
+
+## runs of chars that clean_source_lines only appends to the line (outside of brackets) ##
+plain_chars = re_compile(r"[^'\" \\#\n;:()]+")
+spaces = re_compile(" +")
+word_chars = re_compile(r"[^\W_]+")
+
+
+def clean_source_lines(gen: object, running: bool = False, unpacker: str = "scan") -> None:
     """
     source: str
 
     returns source_lines: list[str],return_linenos: list[int]
 
+    unpacker="ast" lifts the value yields with the ast and emits the lines
+    from it (see gcopy.ast_unpack.emit_source) rather than scanning the source;
+    it falls back to "scan" if the source can't be parsed on its own
+
     1. fixes any indentation issues (when ';' is used) and skips empty lines
     2. split on "\n", ";", and ":"
     3. join up the line continuations i.e. "\ ... " will be skipped
@@ -2224,8 +2464,15 @@ def clean_source_lines(gen: object, running: bool = False) -> None:
     stack_adjuster: adjusts the lines with new lines from unpacking a while loop condition
     fixed_lineno: the lineno of the current line fixed at the first line of unpacking
     """
+    if unpacker not in ("scan", "ast"):
+        raise ValueError("unpacker must be 'scan' or 'ast' not %r" % unpacker)
+    if unpacker == "ast":
+        emitted = emit_source(gen._internals["source"], running)
+        if emitted is not None:
+            gen._internals.update(zip(("source_lines", "jump_positions", "linetable"), emitted))
+            return
     ## create a mutable instance ##
-    self = type("", tuple(), {})()
+    self = LineParts()
     ## for loop adjustments ##
     (
         self.catch,
@@ -2280,12 +2527,18 @@ def clean_source_lines(gen: object, running: bool = False) -> None:
             string_collector_adjust(self)
         ## makes the line singly spaced while retaining the indentation ##
         elif self.char == " ":
-            self.line, self.space, self.indented = singly_space(
-                self.index, self.char, self.line, self.space, self.indented
-            )
+            space, self.space, self.indented = singly_space(self.index, self.char, "", self.space, self.indented)
+            self.parts.append(space)
             if self.indented == 1:
                 update_stack(self, get_indent(self.line))
                 self.indentation = 2
+            ## the rest of the spaces are consecutive e.g. only kept if it's the indentation ##
+            run = spaces.match(self.source, self.index + 1)
+            if run:
+                if not self.indented:
+                    self.parts.append(run.group())
+                self.space = run.end() - 1
+                next(islice(self.source_iter, run.end() - self.index - 2, None), None)
         ## join everything after the line continuation until the next \n or ; ##
         elif self.char == "\\":
             skip_line_continuation(self.source_iter, self.source, self.index)
@@ -2293,7 +2546,7 @@ def clean_source_lines(gen: object, running: bool = False) -> None:
             ## in case of a line continuation without a space before (whitespace after is removed) ##
             ## Note: i.e. 'func        ()' is valid in python ##
             if self.space + 1 != self.index:
-                self.line += " "
+                self.parts.append(" ")
                 self.space = self.index
         ## create new line ##
         elif self.char in "#\n;" or (self.char == ":" and self.source[self.index + 1 : self.index + 2] != "="):
@@ -2317,7 +2570,7 @@ def clean_source_lines(gen: object, running: bool = False) -> None:
                 append_line(self, running)
                 self.depth = 0
         else:
-            self.line += self.char
+            self.parts.append(self.char)
             ## detect value yields [yield] and {yield} is not possible only (yield) ##
             self.depth = update_depth(self.depth, self.char)
             ## '... = yield ...' and '... = yield from ...'
@@ -2330,6 +2583,21 @@ def clean_source_lines(gen: object, running: bool = False) -> None:
                 )
             else:
                 self.ID = ""
+            ## append the rest of the plain chars at once instead of char by char ##
+            if not self.depth:
+                run = plain_chars.match(self.source, self.index + 1)
+                if run:
+                    self.parts.append(run.group())
+                    self.ID = ""
+                    next(islice(self.source_iter, len(run.group()) - 1, None), None)
+            elif self.ID:
+                ## the ID can only be a lambda, yield or ternary at the end of the word ##
+                ## so all but the last char of the word can be added at once ##
+                run = word_chars.match(self.source, self.index + 1)
+                if run and len(run.group()) > 1 and run.group().isalnum():
+                    self.parts.append(run.group()[:-1])
+                    self.ID += run.group()[:-1]
+                    next(islice(self.source_iter, len(run.group()) - 2, None), None)
     ## in case you get a for loop at the end and you haven't got the end jump_position ##
     ## then you just pop them all off as being the same end_lineno ##
     ## note: we don't need a reference indent since the line is over e.g. ##
@@ -2446,7 +2714,9 @@ def genexpr_adjust(self: GeneratorType, source: str) -> None:
         self._locals()[".internals"] = {".4": first_iter}
     ## change the offsets into indents ##
     if track_adjust(self._locals()[".internals"]) or is_running(self._locals()[".internals"][".4"]):
-        self._internals["lineno"] = length
+        ## past the end of the loops to start the next iteration ##
+        self._internals["loops"] = get_loops(length, positions)
+        self._internals["lineno"] = length + 1
     else:
         self._internals["lineno"] = 1
 
@@ -0,0 +1,456 @@
+##################################################
+### ahead-of-time state machine for generators ###
+##################################################
+import ast
+import linecache
+from textwrap import dedent
+from types import CodeType, FunctionType
+from typing import Any
+
+from gcopy.utils import LRUCache, get_nonlocals, getsource, source_hash
+
+## compiled state machines (code objects) keyed by the source hash and the local names ##
+machine_cache = LRUCache(256)
+
+
+class StateMachineError(SyntaxError):
+    """Raised when a generator function cannot be compiled into a state machine"""
+
+
+## the names used by the state machine itself ##
+LOCALS, PC, SENT = "__locals", "__pc", "__sent"
+## the key of an exception thrown into a 'yield from' in the locals ##
+THROW = ".throw"
+
+
+def contains(node: ast.AST, types: tuple[type, ...]) -> bool:
+    """Checks if a node contains any of the node types (not including nested scopes)"""
+    for child in ast.iter_child_nodes(node):
+        if isinstance(child, types):
+            return True
+        if not isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)) and contains(
+            child, types
+        ):
+            return True
+    return False
+
+
+def has_escape(node: ast.AST, in_loop: bool = False) -> bool:
+    """Checks if a statement has a 'break' or 'continue' that leaves the statement"""
+    if isinstance(node, (ast.Break, ast.Continue)):
+        return not in_loop
+    if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef, ast.Lambda)):
+        return False
+    for field, value in ast.iter_fields(node):
+        ## a loops else block is not a part of the loop ##
+        loop = in_loop or isinstance(node, (ast.For, ast.While)) and field == "body"
+        for child in value if isinstance(value, list) else [value]:
+            if isinstance(child, ast.AST) and has_escape(child, loop):
+                return True
+    return False
+
+
+class LocalsRewriter(ast.NodeTransformer):
+    """
+    Rewrites the local variables of a function into
+    subscripts of the state machines locals and
+    returns into the state machines return format
+
+    Note: names shadowed by lambdas and comprehensions are left as is
+    """
+
+    def __init__(self, names: set[str]) -> None:
+        self.names, self.shadowed = names, [set()]
+
+    def visit_Name(self, node: ast.Name) -> ast.AST:
+        if node.id in self.names and node.id not in self.shadowed[-1]:
+            return ast.copy_location(
+                ast.Subscript(ast.Name(LOCALS, ast.Load()), ast.Constant(node.id), node.ctx),
+                node,
+            )
+        return node
+
+    def visit_AnnAssign(self, node: ast.AnnAssign) -> ast.AST:
+        self.generic_visit(node)
+        node.simple = int(isinstance(node.target, ast.Name))
+        return node
+
+    def visit_Return(self, node: ast.Return) -> ast.AST:
+        self.generic_visit(node)
+        value = node.value or ast.Constant(None)
+        return ast.copy_location(ast.Return(ast.Tuple([ast.Constant(-1), value], ast.Load())), node)
+
+    def visit_Lambda(self, node: ast.Lambda) -> ast.AST:
+        args = node.args
+        ## defaults are evaluated in the enclosing scope ##
+        args.defaults = [self.visit(default) for default in args.defaults]
+        args.kw_defaults = [default and self.visit(default) for default in args.kw_defaults]
+        names = {arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs}
+        names |= {arg.arg for arg in (args.vararg, args.kwarg) if arg}
+        self.shadowed += [self.shadowed[-1] | names]
+        node.body = self.visit(node.body)
+        self.shadowed.pop()
+        return node
+
+    def visit_comprehension_scope(self, node: ast.AST) -> ast.AST:
+        ## the first iterator is evaluated in the enclosing scope ##
+        node.generators[0].iter = self.visit(node.generators[0].iter)
+        names = set()
+        for generator in node.generators:
+            names |= {name.id for name in ast.walk(generator.target) if isinstance(name, ast.Name)}
+        self.shadowed += [self.shadowed[-1] | names]
+        for index, generator in enumerate(node.generators):
+            if index:
+                generator.iter = self.visit(generator.iter)
+            generator.ifs = [self.visit(test) for test in generator.ifs]
+        for field in ("elt", "key", "value"):
+            if hasattr(node, field):
+                setattr(node, field, self.visit(getattr(node, field)))
+        self.shadowed.pop()
+        return node
+
+    visit_ListComp = visit_SetComp = visit_DictComp = visit_GeneratorExp = visit_comprehension_scope
+
+
+class StateMachine:
+    """
+    Compiles a generator functions body into a single function
+    of the form:
+
+    def name(__locals, __pc, __sent):
+        while True:
+            if __pc < ...:
+                ...
+            else:
+                ...
+
+    where each leaf of the dispatch is a block of the function
+    that ends in a jump (setting __pc), a yield (returning the
+    resume point and value), or a return (returning -1 and the
+    value). The functions local variables are kept in __locals.
+
+    Only yields as statements, assignments (i.e. ... = yield ...)
+    or 'yield from ...' are supported. if, while, and for
+    statements are flattened into the blocks and everything
+    else that doesn't yield is emitted as is.
+    """
+
+    def __init__(self, names: set[str]) -> None:
+        self.rewriter, self.blocks, self.terminated, self.loops = LocalsRewriter(names), [], set(), []
+        self.current = self.new_block()
+
+    def new_block(self) -> int:
+        self.blocks += [[]]
+        return len(self.blocks) - 1
+
+    def emit(self, *lines: str) -> None:
+        self.blocks[self.current] += lines
+
+    def expr(self, node: ast.AST) -> str:
+        """rewrites and unparses an expression"""
+        if contains(ast.Expr(node), (ast.Yield, ast.YieldFrom, ast.Await, ast.NamedExpr)):
+            raise StateMachineError("Unsupported yield or named expression encountered")
+        return ast.unparse(self.rewriter.visit(node))
+
+    def terminate(self, *lines: str) -> None:
+        """ends the current block with lines that leave the block then starts an unreachable block"""
+        self.emit(*lines)
+        self.terminated.add(self.current)
+        self.current = self.new_block()
+
+    def jump(self, target: int) -> None:
+        self.emit("%s = %s" % (PC, target), "continue")
+        self.terminated.add(self.current)
+
+    def body(self, statements: list[ast.stmt]) -> None:
+        for statement in statements:
+            self.statement(statement)
+
+    def statement(self, node: ast.stmt) -> None:
+        value = getattr(node, "value", None)
+        if isinstance(node, (ast.Expr, ast.Assign)) and isinstance(value, (ast.Yield, ast.YieldFrom)):
+            targets = ""
+            if isinstance(node, ast.Assign):
+                targets = " = ".join(self.expr(target) for target in node.targets) + " = "
+            if isinstance(value, ast.Yield):
+                self.yield_adjust(value, targets)
+            else:
+                self.yield_from_adjust(value, targets)
+        elif isinstance(node, (ast.Global, ast.Pass)):
+            ## globals are declared at the start of the state machine ##
+            pass
+        elif isinstance(node, ast.Return):
+            self.terminate("return (-1, %s)" % self.expr(node.value or ast.Constant(None)))
+        elif isinstance(node, (ast.Break, ast.Continue)):
+            if not self.loops:
+                raise StateMachineError("'%s' outside loop" % type(node).__name__.lower())
+            continue_target, break_target, key = self.loops[-1]
+            if isinstance(node, ast.Break):
+                if key:
+                    self.emit("%s.pop(%r, None)" % (LOCALS, key))
+                self.jump(break_target)
+            else:
+                self.jump(continue_target)
+            self.current = self.new_block()
+        elif not contains(node, (ast.Yield, ast.YieldFrom)) and not has_escape(node):
+            self.verbatim(node)
+        elif isinstance(node, ast.If):
+            self.if_adjust(node)
+        elif isinstance(node, ast.While):
+            self.while_adjust(node)
+        elif isinstance(node, ast.For):
+            self.for_adjust(node)
+        else:
+            raise StateMachineError("Unsupported statement '%s' encountered" % type(node).__name__)
+
+    def verbatim(self, node: ast.stmt) -> None:
+        """emits a statement that doesn't need flattening"""
+        unsupported = (
+            ast.FunctionDef,
+            ast.AsyncFunctionDef,
+            ast.ClassDef,
+            ast.Nonlocal,
+            ast.NamedExpr,
+            ast.Await,
+            ast.AsyncFor,
+            ast.AsyncWith,
+            ast.Match,
+        )
+        if isinstance(node, unsupported) or contains(node, unsupported):
+            raise StateMachineError("Unsupported statement '%s' encountered" % type(node).__name__)
+        node = self.rewriter.visit(node)
+        ## imports and exception names can't be subscripts so they're assigned after ##
+        assignments = []
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            for alias in node.names:
+                name = alias.asname or alias.name.split(".")[0]
+                if name in self.rewriter.names:
+                    assignments += ["%s[%r] = %s" % (LOCALS, name, name)]
+        for handler in ast.walk(node):
+            if isinstance(handler, ast.ExceptHandler) and handler.name in self.rewriter.names:
+                handler.body.insert(0, ast.parse("%s[%r] = %s" % (LOCALS, handler.name, handler.name)).body[0])
+        self.emit(*ast.unparse(node).splitlines(), *assignments)
+
+    def yield_adjust(self, node: ast.Yield, targets: str) -> None:
+        resume = self.new_block()
+        self.emit("return (%s, %s)" % (resume, self.expr(node.value or ast.Constant(None))))
+        self.terminated.add(self.current)
+        self.current = resume
+        if targets:
+            self.emit(targets + SENT)
+
+    def yield_from_adjust(self, node: ast.YieldFrom, targets: str) -> None:
+        """
+        'yield from' delegates next/send and (as in PEP 380) throw/close to the
+        iterator; exceptions thrown in are passed in the locals under '.throw'
+        """
+        key, resume, after = ".yieldfrom", self.new_block(), self.new_block()
+        self.emit("%s[%r] = iter(%s)" % (LOCALS, key, self.expr(node.value)), "%s = None" % SENT)
+        self.jump(resume)
+        self.current = resume
+        self.emit(
+            "try:",
+            "    if %r in %s:" % (THROW, LOCALS),
+            "        __exception = %s.pop(%r)" % (LOCALS, THROW),
+            "        if isinstance(__exception, GeneratorExit):",
+            "            __close = getattr(%s.pop(%r), 'close', None)" % (LOCALS, key),
+            "            if __close is not None:",
+            "                __close()",
+            "            raise __exception",
+            "        __throw = getattr(%s[%r], 'throw', None)" % (LOCALS, key),
+            "        if __throw is None:",
+            "            del %s[%r]" % (LOCALS, key),
+            "            raise __exception",
+            "        %s = __throw(__exception)" % SENT,
+            "    elif %s is None:" % SENT,
+            "        %s = next(%s[%r])" % (SENT, LOCALS, key),
+            "    else:",
+            "        %s = %s[%r].send(%s)" % (SENT, LOCALS, key, SENT),
+            "except StopIteration as __stop:",
+            "    %s.pop(%r, None)" % (LOCALS, key),
+            "    %s__stop.value" % targets,
+            "    %s = %s" % (PC, after),
+            "    continue",
+            "return (%s, %s)" % (resume, SENT),
+        )
+        self.terminated.add(self.current)
+        self.current = after
+
+    def if_adjust(self, node: ast.If) -> None:
+        body, orelse, after = self.new_block(), self.new_block(), self.new_block()
+        self.emit("%s = %s if %s else %s" % (PC, body, self.expr(node.test), orelse), "continue")
+        self.terminated.add(self.current)
+        for block, statements in ((body, node.body), (orelse, node.orelse)):
+            self.current = block
+            self.body(statements)
+            self.jump(after)
+        self.current = after
+
+    def while_adjust(self, node: ast.While) -> None:
+        head, body, orelse, after = self.new_block(), self.new_block(), self.new_block(), self.new_block()
+        self.jump(head)
+        self.current = head
+        self.emit("%s = %s if %s else %s" % (PC, body, self.expr(node.test), orelse), "continue")
+        self.terminated.add(head)
+        self.loop_adjust(node, head, body, orelse, after)
+
+    def for_adjust(self, node: ast.For) -> None:
+        head, body, orelse, after = self.new_block(), self.new_block(), self.new_block(), self.new_block()
+        ## the iterator is stored in the locals so that it's copied/pickled with them ##
+        key = ".for%s" % head
+        self.emit("%s[%r] = iter(%s)" % (LOCALS, key, self.expr(node.iter)))
+        self.jump(head)
+        self.current = head
+        self.emit(
+            "try:",
+            "    %s = next(%s[%r])" % (SENT, LOCALS, key),
+            "except StopIteration:",
+            "    %s = %s" % (PC, orelse),
+            "    continue",
+            "%s = %s" % (self.expr(node.target), SENT),
+        )
+        self.jump(body)
+        self.loop_adjust(node, head, body, orelse, after, key)
+
+    def loop_adjust(self, node: ast.stmt, head: int, body: int, orelse: int, after: int, key: str = "") -> None:
+        self.loops += [(head, after, key)]
+        self.current = body
+        self.body(node.body)
+        self.jump(head)
+        self.loops.pop()
+        self.current = orelse
+        if key:
+            self.emit("%s.pop(%r, None)" % (LOCALS, key))
+        self.body(node.orelse)
+        self.jump(after)
+        self.current = after
+
+    def dispatch(self, ids: list[int], indent: str) -> list[str]:
+        """creates a binary search over the blocks ids"""
+        if len(ids) == 1:
+            return [indent + line for line in self.blocks[ids[0]]]
+        middle = len(ids) // 2
+        return (
+            [indent + "if %s < %s:" % (PC, ids[middle])]
+            + self.dispatch(ids[:middle], indent + " " * 4)
+            + [indent + "else:"]
+            + self.dispatch(ids[middle:], indent + " " * 4)
+        )
+
+    def source(self, name: str, global_names: list[str]) -> str:
+        ## any block that doesn't leave (i.e. the end of the function) returns ##
+        for index, block in enumerate(self.blocks):
+            if index not in self.terminated:
+                block += ["return (-1, None)"]
+        header = ["def %s(%s, %s, %s):" % (name, LOCALS, PC, SENT)]
+        if global_names:
+            header += ["    global " + ", ".join(global_names)]
+        return "\n".join(header + ["    while True:"] + self.dispatch(list(range(len(self.blocks))), " " * 8))
+
+
+def get_function_node(source: str) -> ast.FunctionDef:
+    """Gets the function definition from its (dedented) source"""
+    for node in ast.parse(source).body:
+        if isinstance(node, ast.FunctionDef):
+            return node
+        if isinstance(node, ast.AsyncFunctionDef):
+            raise StateMachineError("async generator functions are not supported")
+    raise StateMachineError("No function definition found")
+
+
+def compile_machine(source: str, names: tuple[str, ...]) -> CodeType:
+    """
+    Compiles a generator functions source into a state machines
+    code object given the names of the functions local variables
+    """
+    key = (source_hash([source]), names)
+    code_obj = machine_cache.get(key)
+    if code_obj is None:
+        node = get_function_node(source)
+        global_names = []
+        for statement in ast.walk(node):
+            if isinstance(statement, ast.Global):
+                global_names += statement.names
+        machine = StateMachine(set(names) - set(global_names))
+        machine.body(node.body)
+        machine_source = machine.source(node.name, global_names)
+        ## register the source so that tracebacks and track_iter can find it ##
+        filename = "<StateMachine %s>" % key[0]
+        linecache.cache[filename] = (len(machine_source), None, machine_source.splitlines(True), filename)
+        for code_obj in compile(machine_source, filename, "exec").co_consts:
+            if isinstance(code_obj, CodeType):
+                break
+        machine_cache[key] = code_obj
+    return code_obj
+
+
+def local_names(code_obj: Any) -> tuple[str, ...]:
+    """All the names that are local to the function (including closure variables)"""
+    return tuple(
+        dict.fromkeys(
+            code_obj.co_varnames + code_obj.co_cellvars + code_obj.co_freevars,
+        )
+    )
+
+
+def machine_init(self: object, FUNC: FunctionType | CodeType | None = None) -> None:
+    """
+    Sets up the state machine for a Generator instance;
+    the source is retrieved if FUNC is given otherwise
+    the existing source is used (i.e. on unpickling)
+    """
+    if FUNC is not None:
+        self._internals["source"] = dedent(getsource(FUNC))
+    code_obj = compile_machine(self._internals["source"], local_names(self._internals["code"]))
+    self._machine = FunctionType(code_obj, self._internals["frame"].f_globals)
+
+
+def machine_close(self: object) -> None:
+    """closes the generator and its state machine"""
+    self._close()
+    self._internals["resume"] = None
+
+
+def machine_next(self: object, exception: str = "", sent: Any = None) -> Any:
+    """Runs the state machine to its next resume point"""
+    resume = self._internals["resume"]
+    if resume is None:
+        raise StopIteration
+    if not hasattr(self, "_machine"):
+        machine_init(self)
+    if sent is not None and resume == 0:
+        raise TypeError("can't send non-None value to a just-started generator")
+    f_locals = self._locals()
+    ## exceptions can't be caught since try statements with yields are not supported ##
+    ## (except by the iterator of a 'yield from' that it's delegated to) ##
+    if exception:
+        exception = eval(exception, self._internals["frame"].f_globals)
+        if ".yieldfrom" not in f_locals:
+            machine_close(self)
+            raise exception
+        f_locals[THROW] = exception() if isinstance(exception, type) else exception
+    for key, value in get_nonlocals(self).items():
+        if key in f_locals:
+            f_locals[key] = value
+    self._internals["running"] = True
+    self._internals["suspended"] = False
+    try:
+        resume, result = self._machine(f_locals, resume, sent)
+    except StopIteration as e:
+        machine_close(self)
+        raise RuntimeError("generator raised StopIteration") from e
+    except BaseException as e:
+        machine_close(self)
+        raise e
+    if resume == -1:
+        machine_close(self)
+        raise StopIteration(*(() if result is None else (result,)))
+    self._internals.update(
+        {
+            "resume": resume,
+            "running": False,
+            "suspended": True,
+            "yieldfrom": f_locals.get(".yieldfrom", None),
+        }
+    )
+    return result
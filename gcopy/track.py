@@ -2,13 +2,13 @@
 ### tracking ###
 ################
 import builtins  # # for consistency (it switches between a module and a dict) ##
-from inspect import currentframe, getframeinfo, getsourcelines
+from inspect import currentframe, getframeinfo
 from types import FrameType, FunctionType
 
 ## for the monkey patching ##
 from typing import Any, Iterable, Iterator
 
-from gcopy.utils import Wrapper, get_history_item, getcode, is_cli
+from gcopy.utils import Wrapper, get_history_item, getcode, getsourcelines, is_cli
 
 
 def get_indent(line: str) -> int:
@@ -1,14 +1,29 @@
+import ast
+import inspect
+import linecache
+import pickle
+from array import array
+from collections import OrderedDict
 from copy import copy, deepcopy
 
 ## needed to access c level memory for the builtin iterators ##
 from ctypes import POINTER, Structure, c_ssize_t, cast, py_object
 from dis import _unpack_opargs
 from functools import wraps
+from hashlib import blake2b
+from io import BytesIO
+from importlib import import_module
+from importlib.util import MAGIC_NUMBER
 from inspect import currentframe
+from marshal import dumps, loads
+from os import getpid, makedirs, replace, stat
+from os.path import abspath, basename, dirname, join, splitext
 from readline import get_current_history_length, get_history_item
-from sys import version_info
-from types import CodeType, FrameType, FunctionType, GeneratorType
+from sys import implementation, version_info
+from threading import RLock
+from types import BuiltinFunctionType, CodeType, FrameType, FunctionType, GeneratorType
 from typing import Any, Callable, Iterable, Iterator
+from weakref import ref
 
 from opcode import opmap
 
@@ -71,6 +86,20 @@ def code_attrs() -> tuple[str, ...]:
     return attrs
 
 
+def source_hash(source_lines: Iterable[str], *extras: Any) -> str:
+    """
+    Fingerprints cleaned source lines (and any extra
+    reprs) in a way that is stable across processes
+    """
+    digest = blake2b(digest_size=16)
+    for line in source_lines:
+        digest.update(line.encode())
+        digest.update(b"\n")
+    for extra in extras:
+        digest.update(repr(extra).encode())
+    return digest.hexdigest()
+
+
 def attr_cmp(obj1: Any, obj2: Any, attrs: Iterable[str]) -> bool:
     """Compares two objects by a collection of their attrs"""
     for attr in attrs:
@@ -149,6 +178,15 @@ def get_globals() -> dict:
     return frame.f_globals
 
 
+def resolve(reference: str) -> Any:
+    """Gets an object from its reference e.g. 'module:qualname'"""
+    module, qualname = reference.split(":")
+    obj = import_module(module)
+    for attr in qualname.split("."):
+        obj = getattr(obj, attr)
+    return obj
+
+
 def similar_opcode(
     code_obj1: CodeType,
     code_obj2: CodeType,
@@ -231,13 +269,73 @@ def get_error():
     raise AttributeError("the required attribute does not exist on the original object")
 
 
-def copier(self, FUNC: FunctionType) -> object:
-    """copying will create a new generator object out of a copied version of the current instance"""
+def copier(self, FUNC: FunctionType, memo: dict | None = None) -> object:
+    """
+    copying will create a new generator object out of a copied version of the current instance
+
+    Note: if given, the new object is recorded in the memo before its attributes are copied
+    """
     obj = type(self)()
+    if memo is not None:
+        memo[id(self)] = obj
     obj.__setstate__(self.__getstate__(FUNC))
     return obj
 
 
+## the types deepcopy treats as atomic ##
+immutable_types = frozenset(
+    (
+        type(None),
+        type(Ellipsis),
+        type(NotImplemented),
+        bool,
+        int,
+        float,
+        complex,
+        str,
+        bytes,
+        range,
+        type,
+        property,
+        ref,
+        CodeType,
+        FunctionType,
+        BuiltinFunctionType,
+    )
+)
+
+
+def immutable(obj: Any) -> bool:
+    """Checks if an object is immutable (including tuples and frozensets of immutable objects)"""
+    if type(obj) in immutable_types:
+        return True
+    if type(obj) in (tuple, frozenset):
+        return all(map(immutable, obj))
+    return False
+
+
+def fast_deepcopy(obj: Any, memo: dict | None = None) -> Any:
+    """
+    deepcopy that shares immutable objects by reference;
+    dicts (i.e. f_locals) are copied per value so that
+    the immutable values within them are also shared
+    """
+    if immutable(obj):
+        return obj
+    if memo is None:
+        memo = {}
+    if type(obj) is not dict:
+        return deepcopy(obj, memo)
+    if id(obj) in memo:
+        return memo[id(obj)]
+    new = memo[id(obj)] = {}
+    for key, value in obj.items():
+        new[fast_deepcopy(key, memo)] = fast_deepcopy(value, memo)
+    ## keep the original alive for the memo (same as deepcopy) ##
+    memo.setdefault(id(memo), []).append(obj)
+    return new
+
+
 class Wrapper:
     """
     Wraps an object in a chain pattern to ensure certain attributes are recorded
@@ -320,7 +418,7 @@ class Wrapper:
         return copier(self, copy)
 
     def __deepcopy__(self, memo: dict) -> object:
-        return copier(self, deepcopy)
+        return copier(self, lambda obj: fast_deepcopy(obj, memo), memo)
 
     def __getstate__(self, FUNC: FunctionType = lambda x: x) -> dict:
         return {"obj": FUNC(self.obj)}
@@ -406,3 +504,332 @@ class SetIteratorView(Structure):
         for attr in self._fields_:
             attr = attr[0]
             setattr(self, attr, getattr(c_iterator.contents, attr))
+
+
+class LRUCache:
+    """
+    Bounded mapping that evicts its least recently used entries
+
+    Note: maxsize=None means unbounded and maxsize=0 disables caching.
+    It's thread safe i.e. states can be compiled in background threads
+    """
+
+    def __init__(self, maxsize: int | None = 128) -> None:
+        self.maxsize, self.lock = maxsize, RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        """clears the entries and resets the hit/miss counters"""
+        with self.lock:
+            self.data, self.hits, self.misses = OrderedDict(), 0, 0
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """gets an entry marking it as the most recently used"""
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def __setitem__(self, key: Any, value: Any) -> None:
+        if self.maxsize == 0:
+            return
+        with self.lock:
+            self.data[key] = value
+            self.data.move_to_end(key)
+            self.resize(self.maxsize)
+
+    def __contains__(self, key: Any) -> bool:
+        return key in self.data
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def resize(self, maxsize: int | None) -> None:
+        """sets the size limit evicting the least recently used entries if necessary"""
+        with self.lock:
+            self.maxsize = maxsize
+            if maxsize is not None:
+                while len(self.data) > maxsize:
+                    self.data.popitem(last=False)
+
+    def info(self) -> dict:
+        """hit/miss counters and sizes similar to functools.lru_cache.cache_info"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "maxsize": self.maxsize,
+            "currsize": len(self.data),
+        }
+
+
+class DiskCache:
+    """
+    Persistent cache of marshallable entries per source file that's stored
+    alongside __pycache__ i.e. __pycache__/<name>.gcopy.<cache_tag>.marshal
+
+    Like .pyc files the entries are for the current Python version (the cache
+    tag + magic number) and are invalidated when the source file changes
+    (the mtime + size, and if they differ, the content hash is compared)
+
+    Note: disabled by default; set enabled = True to use it and directory
+    to store the files in a single directory instead of each __pycache__
+    """
+
+    def __init__(self, enabled: bool = False, directory: str | None = None) -> None:
+        self.enabled, self.directory, self.lock = enabled, directory, RLock()
+        self.clear()
+
+    def clear(self) -> None:
+        """clears the loaded entries (the files are left as they are)"""
+        ## filename: [stat, content hash, entries, modified] ##
+        self.files, self.hits, self.misses = {}, 0, 0
+
+    def path(self, filename: str) -> str:
+        """the cache file for a source file"""
+        name = splitext(basename(filename))[0]
+        if self.directory is None:
+            directory = join(dirname(abspath(filename)), "__pycache__")
+        else:
+            ## to avoid collisions between files with the same name ##
+            directory = self.directory
+            name += "-" + source_hash([abspath(filename)])[:8]
+        return join(directory, "%s.gcopy.%s.marshal" % (name, implementation.cache_tag))
+
+    def load(self, filename: str) -> dict | None:
+        """loads (and validates) the entries of a source file"""
+        try:
+            info = stat(filename)
+        except OSError:
+            return None
+        file_stat = (info.st_mtime_ns, info.st_size)
+        record = self.files.get(filename)
+        if record is None:
+            try:
+                with open(self.path(filename), "rb") as file:
+                    magic, *record = loads(file.read())
+                if magic != MAGIC_NUMBER:
+                    raise ValueError
+                record += [False]
+            except (OSError, ValueError, EOFError, TypeError):
+                record = [None, None, {}, False]
+            self.files[filename] = record
+        if record[0] != file_stat:
+            with open(filename, "rb") as file:
+                content_hash = blake2b(file.read(), digest_size=16).hexdigest()
+            if record[1] != content_hash:
+                record[1:3] = [content_hash, {}]
+            record[0], record[3] = file_stat, True
+        return record[2]
+
+    def get(self, filename: str, key: Any, default: Any = None) -> Any:
+        """gets an entry for a source file"""
+        with self.lock:
+            entries = self.load(filename) if self.enabled else None
+            if entries is None or key not in entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entries[key]
+
+    def set(self, filename: str, key: Any, value: Any) -> None:
+        """sets an entry for a source file (written on save)"""
+        with self.lock:
+            entries = self.load(filename) if self.enabled else None
+            if entries is not None:
+                entries[key] = value
+                self.files[filename][3] = True
+
+    def save(self) -> None:
+        """writes the modified entries (errors are ignored like with __pycache__)"""
+        with self.lock:
+            for filename, record in self.files.items():
+                if not record[3]:
+                    continue
+                path = self.path(filename)
+                try:
+                    makedirs(dirname(path), exist_ok=True)
+                    ## write then replace so that concurrent readers don't see a partial file ##
+                    temp = "%s.%s.tmp" % (path, getpid())
+                    with open(temp, "wb") as file:
+                        file.write(dumps([MAGIC_NUMBER] + record[:3]))
+                    replace(temp, path)
+                    record[3] = False
+                except (OSError, ValueError):
+                    pass
+
+
+class SourceIndex:
+    """
+    A parsed source file e.g. its lines, its ast, and its function, lambda,
+    and genexpr nodes by lineno (functions also by their decorators linenos)
+
+    Note: the ast and the nodes are only made when they're first needed
+    """
+
+    __slots__ = ("stat", "lines", "_tree", "_nodes")
+
+    def __init__(self, stat: tuple[int, int], lines: list[str]) -> None:
+        self.stat, self.lines, self._tree, self._nodes = stat, lines, None, None
+
+    @property
+    def tree(self) -> ast.Module:
+        if self._tree is None:
+            self._tree = ast.parse("".join(self.lines))
+        return self._tree
+
+    @property
+    def nodes(self) -> dict[int, list[ast.AST]]:
+        if self._nodes is None:
+            nodes = {}
+            for node in ast.walk(self.tree):
+                if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                    for lineno in {node.lineno} | {decorator.lineno for decorator in node.decorator_list}:
+                        nodes.setdefault(lineno, []).append(node)
+                elif isinstance(node, (ast.Lambda, ast.GeneratorExp)):
+                    nodes.setdefault(node.lineno, []).append(node)
+            self._nodes = nodes
+        return self._nodes
+
+    def function(self, code_obj: CodeType) -> ast.AST | None:
+        """The function definition of a code object (if there's exactly one)"""
+        nodes = [
+            node
+            for node in self.nodes.get(code_obj.co_firstlineno, ())
+            if getattr(node, "name", None) == code_obj.co_name
+        ]
+        if len(nodes) == 1:
+            return nodes[0]
+        return None
+
+
+## the source indexes by filename (see source_index); the least recently used are ##
+## evicted once there are more than source_index_lines lines in total or on resize ##
+source_indexes = LRUCache(64)
+source_index_lines = 200000
+
+
+def source_index(filename: str) -> SourceIndex | None:
+    """
+    The SourceIndex of a source file; it's rebuilt if the
+    file has changed (mtime + size) or None if it can't be read
+    """
+    try:
+        info = stat(filename)
+    except (OSError, TypeError, ValueError):
+        return None
+    file_stat = (info.st_mtime_ns, info.st_size)
+    index = source_indexes.get(filename)
+    if index is not None and index.stat == file_stat:
+        return index
+    linecache.checkcache(filename)
+    lines = linecache.getlines(filename)
+    if not lines:
+        return None
+    index = source_indexes[filename] = SourceIndex(file_stat, lines)
+    with source_indexes.lock:
+        total = sum(len(index.lines) for index in source_indexes.data.values())
+        while len(source_indexes) > 1 and total > source_index_lines:
+            total -= len(source_indexes.data.popitem(last=False)[1].lines)
+    return index
+
+
+def findsource(obj: Any) -> tuple[list[str], int]:
+    """inspect.findsource via the source index of its file (otherwise inspect is used)"""
+    code_obj = obj if isinstance(obj, CodeType) else getcode(obj)
+    index = source_index(code_obj.co_filename)
+    if index is None:
+        return inspect.findsource(obj)
+    return index.lines, code_obj.co_firstlineno - 1
+
+
+def getsourcelines(obj: Any) -> tuple[list[str], int]:
+    """inspect.getsourcelines via the source index for functions (otherwise inspect is used)"""
+    code_obj = obj if isinstance(obj, CodeType) else getcode(obj)
+    index = source_index(code_obj.co_filename)
+    node = index and index.function(code_obj)
+    if not node:
+        return inspect.getsourcelines(obj)
+    return index.lines[code_obj.co_firstlineno - 1 : node.end_lineno], code_obj.co_firstlineno
+
+
+def getsource(obj: Any) -> str:
+    """inspect.getsource via the source index for functions (otherwise inspect is used)"""
+    return "".join(getsourcelines(obj)[0])
+
+
+class BufferPickler(pickle.Pickler):
+    """
+    Pickles (protocol 5) bytes, bytearray, memoryview and array.array
+    objects of at least threshold bytes as out-of-band buffers
+
+    Note: these are recorded as persistent ids since bytes and bytearray
+    are saved directly by the pickler (i.e. reducer_override doesn't get
+    them); memoryviews are always recorded (they can't be pickled otherwise)
+    but the ones that aren't C-contiguous are copied into bytes or bytearray
+    (pickled as usual e.g. in-band if they're smaller than the threshold)
+    """
+
+    threshold = 1 << 16
+
+    def persistent_id(self, obj: Any) -> tuple | None:
+        if type(obj) not in (bytes, bytearray, memoryview, array):
+            return None
+        view = memoryview(obj)
+        if type(obj) is memoryview:
+            ## their raw memory isn't in the order of their elements (PickleBuffer.raw fails) ##
+            if not view.c_contiguous:
+                data = view.tobytes() if view.readonly else bytearray(view.tobytes())
+                return "memoryview", data, (view.format, view.shape)
+            return "memoryview", pickle.PickleBuffer(obj), (view.format, view.shape)
+        if view.nbytes < self.threshold:
+            return None
+        if type(obj) is array:
+            return "array", pickle.PickleBuffer(obj), obj.typecode
+        return type(obj).__name__, pickle.PickleBuffer(obj), None
+
+
+class BufferUnpickler(pickle.Unpickler):
+    """
+    Unpickles the out-of-band buffers of BufferPickler
+    (bytes, bytearray and memoryview aren't copied if possible)
+    """
+
+    def persistent_load(self, pid: tuple) -> Any:
+        kind, buffer, info = pid
+        if kind == "array":
+            obj = array(info)
+            obj.frombytes(memoryview(buffer).cast("B"))
+            return obj
+        if kind == "memoryview":
+            view = memoryview(buffer)
+            if (view.format, view.shape) != info:
+                view = view.cast("B").cast(*info)
+            return view
+        cls = bytes if kind == "bytes" else bytearray
+        if type(buffer) is cls:
+            return buffer
+        return cls(buffer)
+
+
+def dumps_oob(obj: Any, threshold: int = BufferPickler.threshold) -> tuple[bytes, list[pickle.PickleBuffer]]:
+    """
+    Pickles an object (i.e. a Generator) with protocol 5 returning
+    the pickle and the buffers of its large bytes, bytearray,
+    memoryview and array.array objects (see BufferPickler) that
+    can be transferred separately without being copied
+    """
+    file, buffers = BytesIO(), []
+    pickler = BufferPickler(file, 5, buffer_callback=buffers.append)
+    pickler.threshold = threshold
+    pickler.dump(obj)
+    return file.getvalue(), buffers
+
+
+def loads_oob(data: bytes, buffers: Iterable) -> Any:
+    """Unpickles the result of dumps_oob"""
+    return BufferUnpickler(BytesIO(data), buffers=buffers).load()
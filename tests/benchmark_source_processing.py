@@ -0,0 +1,102 @@
+"""
+Benchmarks of the source processing (not collected by pytest)
+
+run via: python -m tests.benchmark_source_processing [revision]
+
+where the scanner is compared against the one at the git revision (HEAD by default)
+"""
+
+import ast
+import sys
+from contextlib import redirect_stdout
+from importlib.util import module_from_spec, spec_from_loader
+from io import StringIO
+from os.path import dirname
+from subprocess import check_output
+from textwrap import dedent
+from timeit import repeat
+from types import ModuleType
+
+from gcopy import source_processing
+from gcopy.source_processing import clean_source_lines
+
+ROOT = dirname(dirname(__file__))
+
+
+def value_yields_source(statements: int = 200) -> str:
+    """a generator function of value yields and loops"""
+    lines = ["def test(a):"]
+    for i in range(statements // 4):
+        lines += [
+            "    x%s = (yield %s) + a" % (i, i),
+            "    for i in range(x%s):" % i,
+            "        print(i, (yield i), a)",
+            "    a = [x%s,\n         a]" % i,
+        ]
+    return "\n".join(lines) + "\n"
+
+
+def corpus_sources() -> list[str]:
+    """the sources of the functions in tests/test_source_processing.py and a function with a long line"""
+    with open(ROOT + "/tests/test_source_processing.py") as file:
+        source = file.read()
+    lines, sources = source.splitlines(True), []
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            start = node.decorator_list[0].lineno if node.decorator_list else node.lineno
+            sources += [dedent("".join(lines[start - 1 : node.end_lineno]))]
+    return sources + ["def test():\n    a = [%s]\n    yield a\n" % ", ".join(map(str, range(2000)))]
+
+
+def old_scanner(revision: str = "HEAD") -> ModuleType:
+    """gcopy.source_processing at a git revision"""
+    source = check_output(["git", "show", revision + ":gcopy/source_processing.py"], cwd=ROOT, text=True)
+    module = module_from_spec(spec_from_loader("old_source_processing", loader=None))
+    exec(compile(source, "old_source_processing.py", "exec"), module.__dict__)
+    return module
+
+
+def clean(source: str, unpacker: str = "scan", module: ModuleType = source_processing) -> None:
+    class gen:
+        _internals = {"source": source}
+
+    if unpacker == "scan":
+        module.clean_source_lines(gen, True)
+    else:
+        clean_source_lines(gen, True, unpacker)
+
+
+def bench_unpacker(number: int = 20) -> dict[str, float]:
+    """the best time (in seconds) per clean_source_lines call for each unpacker"""
+    source = value_yields_source()
+    return {
+        unpacker: min(repeat(lambda: clean(source, unpacker), number=number, repeat=5)) / number
+        for unpacker in ("scan", "ast")
+    }
+
+
+def bench_scanner(revision: str = "HEAD", number: int = 5) -> dict[str, float]:
+    """the best time (in seconds) to clean the corpus with the old and current scanner"""
+    modules = {"old": old_scanner(revision), "new": source_processing}
+    sources = []
+    ## the sources the scanner can't clean are left out (it prints while unpacking some) ##
+    with redirect_stdout(StringIO()):
+        for source in corpus_sources():
+            try:
+                for module in modules.values():
+                    clean(source, module=module)
+                sources += [source]
+            except Exception:
+                pass
+        return {
+            name: min(repeat(lambda: [clean(source, module=module) for source in sources], number=number, repeat=5))
+            / number
+            for name, module in modules.items()
+        }
+
+
+if __name__ == "__main__":
+    for unpacker, seconds in bench_unpacker().items():
+        print("%s: %.2fms" % (unpacker, seconds * 1000))
+    for name, seconds in bench_scanner(*sys.argv[1:]).items():
+        print("%s scanner: %.2fms" % (name, seconds * 1000))
@@ -0,0 +1,170 @@
+import ast
+import pickle
+
+from gcopy.ast_unpack import YieldLifter, emit_source
+from gcopy.custom_generator import Generator
+from gcopy.source_processing import clean_source_lines
+
+
+def value_yields():
+    total = 0
+    x = yield 0
+    total += (yield (x or 0) * 2) or 0
+    y = 1 if (yield "t") else 2
+    yield total + y
+
+
+def mid_line():
+    x = (yield 1) + (1 if (yield 2) else 2)
+    print((yield x), (yield))
+
+
+def ternary_branch():
+    w = (yield 4) if True else (yield 5)
+    yield w
+
+
+def boolop_operand():
+    v = None or (yield 6)
+    yield v
+
+
+def while_condition():
+    n = 0
+    while (yield n) != "stop":
+        n += 1
+    yield "done"
+
+
+def lift(source: str) -> str:
+    tree = ast.parse(source)
+    tree.body = YieldLifter().block(tree.body)
+    return ast.unparse(ast.fix_missing_locations(tree))
+
+
+def test_YieldLifter() -> None:
+    ## yield statements are left as is ##
+    assert lift("yield 1") == "yield 1"
+    assert lift("x = yield 1") == "yield 1\nx = locals()['.internals']['.send']"
+    assert lift("print((yield 1) + 2)") == (
+        "yield 1\n"
+        "locals()['.internals']['.lift0'] = locals()['.internals']['.send']\n"
+        "print(locals()['.internals'].pop('.lift0') + 2)"
+    )
+    ## ternaries ##
+    assert lift("x = (yield 1) if a else 2") == (
+        "if a:\n"
+        "    yield 1\n"
+        "    locals()['.internals']['.lift1'] = locals()['.internals']['.send']\n"
+        "    locals()['.internals']['.lift0'] = locals()['.internals'].pop('.lift1')\n"
+        "else:\n"
+        "    locals()['.internals']['.lift0'] = 2\n"
+        "x = locals()['.internals'].pop('.lift0')"
+    )
+    ## walrus ##
+    assert lift("f(x := (yield))") == (
+        "yield\n"
+        "locals()['.internals']['.lift0'] = locals()['.internals']['.send']\n"
+        "x = locals()['.internals'].pop('.lift0')\n"
+        "f(x)"
+    )
+    assert lift("x = yield from a") == "yield from a\nx = None"
+    ## loop conditions are lifted into the loop ##
+    assert lift("while (yield):\n    pass") == (
+        "while True:\n"
+        "    yield\n"
+        "    locals()['.internals']['.lift0'] = locals()['.internals']['.send']\n"
+        "    if not locals()['.internals'].pop('.lift0'):\n"
+        "        break\n"
+        "    pass"
+    )
+    ## nested scopes ##
+    assert lift("def f():\n    x = yield") == "def f():\n    x = (yield)"
+
+
+def test_emit_source() -> None:
+    source_lines, jump_positions, linetable = emit_source(
+        "def test():\n    a = 1\n    print((yield a),\n          a)\n    for i in a:\n        yield from i\n    return a\n",
+        True,
+    )
+    assert source_lines[:5] == [
+        "    a = 1",
+        "    return a",
+        "    locals()['.internals']['.lift0'] = locals()['.internals']['.send']",
+        "    print(locals()['.internals'].pop('.lift0'), a)",
+        "    for i in a:",
+    ]
+    assert source_lines[-1] == "    return locals()['.internals']['EOF'](a)"
+    assert jump_positions == [[5, 10], [7, 10]]
+    ## a line maps to the return of its yield (or otherwise the last line emitted) ##
+    assert linetable == [0, 1, 2, 4, 5, 9, 11, 11]
+    ## yields after a value yield of the same statement can't be resumed from ##
+    assert emit_source("def test():\n    print((yield 1) + (yield 2))\n", True)[2][1] == ((11, 1), (23, None))
+    ## the sent value of an outer yield is used by the time it yields ##
+    assert emit_source("def test():\n    yield (yield 1)\n", True)[2][1] == ((11, 1), (4, 3))
+    ## ternaries with no yields are left as is ##
+    assert emit_source("def test():\n    x = (1 if a else 2)\n    yield x\n")[0][0] == "    x = (1 if a else 2)"
+    assert emit_source("lambda: (yield)") is None
+    assert emit_source("def test(:") is None
+    ## yields that can't be lifted ##
+    assert emit_source("def test():\n    try:\n        pass\n    except (yield):\n        pass\n") is None
+
+
+def test_clean_source_lines() -> None:
+    class gen:
+        _internals = {"source": "def test():\n    print((yield 1) + (yield 2))\n"}
+
+    clean_source_lines(gen, True, "ast")
+    assert gen._internals["source_lines"] == [
+        "    return 1",
+        "    locals()['.internals']['.lift0'] = locals()['.internals']['.send']",
+        "    return 2",
+        "    locals()['.internals']['.lift1'] = locals()['.internals']['.send']",
+        "    print((locals()['.internals'].pop('.lift0')) + (locals()['.internals'].pop('.lift1')))",
+    ]
+    ## the second yield can't be resumed from ##
+    assert gen._internals["linetable"][1] == ((11, 1), (23, None))
+
+
+def test_ast_unpacker() -> None:
+    gen = Generator(value_yields, unpacker="ast")()
+    assert gen._internals["unpacker"] == "ast"
+    assert (next(gen), gen.send(5), gen.send(3)) == (0, 10, "t")
+    gen_copy, gen_pickle = gen.copy(), pickle.loads(pickle.dumps(gen))
+    assert (gen.send(1), gen_copy.send(None), gen_pickle.send(1)) == (4, 5, 4)
+    ## running generators ##
+    gen = value_yields()
+    next(gen)
+    gen.send(4)
+    assert Generator(gen, unpacker="ast").send(7) == gen.send(7)
+    ## ternaries and yields on the same line ##
+    gen, gen_ast = mid_line(), Generator(mid_line, unpacker="ast")()
+    assert [next(gen), gen.send(0), gen.send(None)] == [next(gen_ast), gen_ast.send(0), gen_ast.send(None)]
+    gen = mid_line()
+    next(gen)
+    assert Generator(gen, unpacker="ast").send(1) == gen.send(1)
+    try:
+        Generator(gen, unpacker="ast")
+        assert False
+    except ValueError:
+        pass
+    try:
+        Generator(value_yields, unpacker="tokens")
+        assert False
+    except ValueError:
+        pass
+    ## yields in nested statements of the lifted statements ##
+    for FUNC, sends in (
+        (ternary_branch, [None, 1]),
+        (boolop_operand, [None, 2]),
+        (while_condition, [None, 1, 2, "stop"]),
+    ):
+        gen, gen_ast = FUNC(), Generator(FUNC, unpacker="ast")()
+        assert [gen.send(arg) for arg in sends] == [gen_ast.send(arg) for arg in sends]
+
+
+if __name__ == "__main__":
+    test_YieldLifter()
+    test_emit_source()
+    test_clean_source_lines()
+    test_ast_unpacker()
@@ -0,0 +1,155 @@
+import pickle
+from dis import _parse_exception_table
+from types import FunctionType
+
+from gcopy.bytecode import (
+    NULL,
+    exception_entry,
+    localsplus_names,
+    no_location,
+    resume_code,
+    supported,
+    value_stack,
+)
+from gcopy.custom_generator import Generator
+
+
+def simple_generator(n, *args, k=3):
+    x = 1
+    for i in range(n):
+        yield (lambda: x)() + i
+    print("a", (yield "print"), "b", args, k)
+    result = yield from sub_generator()
+    yield result
+
+
+def sub_generator():
+    sent = yield "sub"
+    yield sent
+    return "return"
+
+
+def try_generator():
+    try:
+        yield 1
+        yield 2
+    except ValueError:
+        yield "caught"
+    finally:
+        yield "finally"
+
+
+def run(gen, first: bool) -> list:
+    """runs a generator to completion (the first value is sent if it has started)"""
+    values = []
+    try:
+        values += [gen.send("sent") if first else next(gen)]
+        while True:
+            values += [next(gen)]
+    except StopIteration:
+        pass
+    return values
+
+
+def test_localsplus_names() -> None:
+    def test(a, b):
+        c = 1
+        yield lambda: a + c
+
+    ## 'a' is both an argument and a cell ##
+    assert localsplus_names(test.__code__) == ("a", "b", "c")
+
+
+def test_exception_entry() -> None:
+    class test:
+        co_exceptiontable = exception_entry(2, 10, 70000, 300, True) + exception_entry(262144, 262148, 8, 0, False)
+
+    entries = [tuple(entry) for entry in _parse_exception_table(test)]
+    assert entries == [(2, 10, 70000, 300, True), (262144, 262148, 8, 0, False)]
+
+
+def test_no_location() -> None:
+    assert no_location(0) == b""
+    assert len(no_location(8)) == 1
+    assert len(no_location(9)) == 2
+
+
+def test_value_stack() -> None:
+    if not supported:
+        return
+    gen = simple_generator(3)
+    next(gen)
+    assert [type(value) for value in value_stack(gen.gi_frame)] == [type(iter(range(0)))]
+    for _ in range(3):
+        next(gen)
+    assert value_stack(gen.gi_frame) == [NULL, print, "a"]
+
+
+def test_resume_code() -> None:
+    if not supported:
+        return
+    gen = simple_generator(3)
+    next(gen)
+    code_obj = resume_code(gen.gi_code, {"n": 3, "i": 0, "x": 1}, [iter(range(1, 3))], gen.gi_frame.f_lasti)
+    assert code_obj.co_argcount == 0
+    ## the first next goes to the resume point ##
+    new_gen = FunctionType(code_obj, globals())()
+    assert next(new_gen) is None
+    assert [next(new_gen), next(new_gen), next(new_gen)] == [2, 3, "print"]
+
+
+def test_bytecode_engine() -> None:
+    if not supported:
+        assert Generator(sub_generator, "bytecode")._internals["engine"] == "source"
+        return
+    ## copying at every resume point ##
+    for index in range(8):
+        gen = Generator(simple_generator, "bytecode")(3, 9, k=4)
+        assert gen._internals["engine"] == "bytecode"
+        for _ in range(index):
+            next(gen)
+        gen_copy = gen.copy()
+        assert run(gen_copy.copy(), index) == run(gen_copy, index) == run(gen, index)
+    ## copies of resumed copies (before and after advancing them) ##
+    for index in range(8):
+        gen = Generator(simple_generator, "bytecode")(3, 9, k=4)
+        for _ in range(index):
+            next(gen)
+        gen_copy = gen.copy()
+        gen_copy._native
+        assert run(gen_copy.copy(), index) == run(gen.copy(), index)
+        if next(gen_copy, None) is not None:
+            next(gen)
+            assert run(gen_copy.copy(), False) == run(gen_copy, False) == run(gen, False)
+    ## pickling ##
+    gen = Generator(simple_generator(3), "bytecode")
+    next(gen)
+    new_gen = pickle.loads(pickle.dumps(Generator(sub_generator(), "bytecode")))
+    assert list(new_gen) == ["sub", None]
+    ## repickling resumed generators ##
+    gen = Generator(sub_generator(), "bytecode")
+    next(gen)
+    new_gen = pickle.loads(pickle.dumps(gen))
+    assert new_gen.send("sent") == "sent"
+    assert list(pickle.loads(pickle.dumps(pickle.loads(pickle.dumps(new_gen))))) == list(new_gen) == []
+    new_gen = pickle.loads(pickle.dumps(gen))
+    new_gen._native
+    assert pickle.loads(pickle.dumps(new_gen)).send("sent") == gen.send("sent") == "sent"
+    ## throw + close ##
+    gen = Generator(try_generator(), "bytecode")
+    next(gen)
+    gen_copy = gen.copy()
+    assert gen_copy.throw(ValueError) == "caught"
+    assert list(gen_copy) == ["finally"]
+    assert list(gen) == [2, "finally"]
+    ## closed ##
+    assert list(gen.copy()) == []
+
+
+if __name__ == "__main__":
+    test_localsplus_names()
+    test_exception_entry()
+    test_no_location()
+    test_value_stack()
+    test_resume_code()
+    test_bytecode_engine()
@@ -1,22 +1,31 @@
 import asyncio
+import linecache
 from collections.abc import Iterable
 import pickle
 from functools import partial, wraps
+from gc import collect
 from inspect import currentframe
 from sys import exc_info
+from tempfile import TemporaryDirectory
 
 # from collections.abc import Iterable, Iterat, AsyncIterable, AsyncIterator
-from types import AsyncGeneratorType, GeneratorType, NoneType
+from types import AsyncGeneratorType, CodeType, FrameType, GeneratorType, NoneType
 from typing import Any
 
+from gcopy import custom_generator
 from gcopy.custom_generator import (
     EOF,
     AsyncGenerator,
     BaseGenerator,
     Generator,
     Pickler,
+    block_cache,
     code,
     frame,
+    frame_snapshot,
+    plan_cache,
+    source_hashes,
+    state_cache,
 )
 from gcopy.source_processing import (
     append_line,
@@ -27,8 +36,8 @@ from gcopy.source_processing import (
     unpack,
     update_jump_positions,
 )
-from gcopy.track import atrack, patch_iterators
-from gcopy.utils import attr_cmp, copier, get_globals, get_nonlocals, getcode
+from gcopy.track import atrack, patch_iterators, track
+from gcopy.utils import attr_cmp, copier, dumps_oob, get_globals, get_nonlocals, getcode, loads_oob
 
 #########################
 ### testing utilities ###
@@ -41,6 +50,13 @@ class pickler(Pickler):
     _attrs = ("a", "b", "c")
 
 
+class uncopyable:
+    """can be pickled but not copied"""
+
+    def __deepcopy__(self, memo: dict) -> None:
+        raise TypeError("cannot copy")
+
+
 def setup() -> object:
     """setup used for jump_positions"""
     self = type("", tuple(), {})()
@@ -176,6 +192,188 @@ def test_picklers() -> None:
     test_Pickler(AsyncGenerator())
 
 
+def test_code_interning() -> None:
+    def test():
+        yield 1
+
+    ## the same instance for the same code object, and copies are shared ##
+    _code = code(test.__code__)
+    assert code(test.__code__) is _code and _code.copy() is _code
+    assert Generator(test)._internals["code"] is Generator(test)()._internals["code"] is _code
+    ## replace creates a new instance ##
+    new_code = _code.replace(co_name="new")
+    assert new_code is not _code and new_code.co_name == "new" and _code.co_name == "test"
+    ## code objects that compare equal but are from another file are interned separately ##
+    other = test.__code__.replace(co_filename="other.py")
+    assert other == test.__code__ and code(other).co_filename == "other.py"
+    ## and are removed when their code object is garbage collected ##
+    key = id(other)
+    assert key in custom_generator.code_cache
+    del other
+    assert key not in custom_generator.code_cache
+    ## no __dict__ ##
+    assert not hasattr(_code, "__dict__") and not hasattr(frame(), "__dict__")
+    assert pickle.loads(pickle.dumps(_code)) == _code
+
+
+def test_frame_snapshot() -> None:
+    def test(a: int) -> FrameType:
+        return currentframe()
+
+    _frame = test(1)
+    snapshot = frame_snapshot(_frame)
+    assert snapshot.f_locals is _frame.f_locals and snapshot.f_back is None
+    assert snapshot.f_globals is _frame.f_globals
+    ## f_code is only wrapped when it's accessed ##
+    assert isinstance(snapshot._f_code, CodeType)
+    assert snapshot.f_code == code(_frame.f_code) and isinstance(snapshot._f_code, code)
+    ## copying ##
+    snapshot_copy = snapshot.copy()
+    assert type(snapshot_copy) is frame_snapshot and snapshot_copy.f_lineno == snapshot.f_lineno
+
+
+def test_deferred_copy() -> None:
+    def test():
+        data = [0]
+        yield 0
+        data.append(1)
+        yield len(data)
+        data.append(2)
+        yield len(data)
+
+    gen = Generator(test)()
+    next(gen)
+    gen_copy = gen.copy(deferred=True)
+    ## the locals are shared until a state that uses them is run ##
+    assert gen_copy._internals["frame"].f_locals["data"] is gen._internals["frame"].f_locals["data"]
+    assert gen._internals["shared"][0] == gen_copy._internals["shared"][0] == {"data", ".internals"}
+    assert next(gen_copy) == 2
+    assert gen_copy._internals["frame"].f_locals["data"] is not gen._internals["frame"].f_locals["data"]
+    assert list(gen) == [2, 3] and list(gen_copy) == [3]
+    ## not included in copies or pickles ##
+    gen = Generator(test)()
+    next(gen)
+    gen_copy = gen.copy(deferred=True)
+    assert "shared" not in gen.copy()._internals
+    assert list(gen.copy(deferred=True)) == list(gen_copy) == list(gen) == [2, 3]
+
+    ## the locals that aren't used (until the next yield) stay shared ##
+    def test():
+        buffer, data = [0], [1]
+        yield buffer
+        data.append(2)
+        yield data
+        buffer.append(3)
+        yield buffer
+
+    gen = Generator(test)()
+    next(gen)
+    gen_copy = gen.copy(deferred=True)
+    assert next(gen_copy) == [1, 2]
+    f_locals, copy_locals = gen._internals["frame"].f_locals, gen_copy._internals["frame"].f_locals
+    assert copy_locals["buffer"] is f_locals["buffer"] and copy_locals["data"] is not f_locals["data"]
+    assert gen_copy._internals["shared"][0] == {"buffer"}
+    assert next(gen_copy) == [0, 3] and "shared" not in gen_copy._internals
+    assert list(gen) == [[1, 2], [0, 3]]
+
+    ## the aliasing between the locals is kept ##
+    def test():
+        data = [0]
+        alias = [data]
+        yield
+        data.append(1)
+        yield
+        yield alias
+
+    gen = Generator(test)()
+    next(gen)
+    gen_copy = gen.copy(deferred=True)
+    next(gen_copy)
+    assert gen_copy._internals["shared"][0] == {"alias"}
+    assert next(gen_copy) == [[0, 1]] and list(gen) == [None, [[0, 1]]]
+
+
+def test_prune_locals() -> None:
+    def test(n):
+        buffer = list(range(n))
+        total = sum(buffer)
+        yield total
+        other = total + 1
+        yield other
+        yield n
+
+    gen = Generator(test)(10)
+    next(gen)
+    assert gen._dead_locals() == {"buffer"}
+    try:
+        custom_generator.prune_locals = True
+        gen_copy = gen.copy()
+        new_gen = pickle.loads(pickle.dumps(gen))
+    finally:
+        custom_generator.prune_locals = False
+    assert "buffer" not in gen_copy._locals() and "buffer" not in new_gen._locals()
+    assert "buffer" in gen._locals() and "buffer" in gen.copy()._locals()
+    assert list(gen_copy) == list(gen) == [46, 10]
+
+
+def test_compact_pickle() -> None:
+    gen = Generator(simple_generator())
+    next(gen)
+    reference = gen._reference()
+    assert reference[0].endswith(":simple_generator") and reference[1] == gen._internals["fingerprint"]
+    try:
+        custom_generator.compact_pickle = True
+        data = pickle.dumps(gen)
+    finally:
+        custom_generator.compact_pickle = False
+    assert len(data) < len(pickle.dumps(gen))
+    new_gen = pickle.loads(data)
+    assert new_gen._internals["source_lines"] == gen._internals["source_lines"]
+    assert new_gen._internals["code"] is gen._internals["code"]
+    assert list(new_gen) == list(gen) == [2, 3]
+    ## the source has changed ##
+    try:
+        Generator(simple_generator())._restore(reference[0], "", False)
+        assert False
+    except ValueError:
+        pass
+    ## locally defined functions can't be referenced ##
+    def test():
+        yield 1
+
+    gen = Generator(test())
+    assert gen._reference() is None
+
+
+def test_pickle_oob() -> None:
+    def test():
+        data = bytearray(1 << 16)
+        yield len(data)
+        data[0] = 1
+        yield data[0]
+
+    gen = Generator(test())
+    next(gen)
+    data, buffers = dumps_oob(gen)
+    assert len(buffers) == 1 and len(data) < 1 << 16
+    assert list(loads_oob(data, buffers)) == list(gen) == [1]
+
+
+def test_pickle_without_copying() -> None:
+    def test():
+        value = uncopyable()
+        yield 1
+        yield type(value).__name__
+
+    gen = Generator(test())
+    next(gen)
+    ## pickling doesn't copy the frame (or any Pickler) first ##
+    new_gen = pickle.loads(pickle.dumps(gen))
+    assert list(new_gen) == ["uncopyable"]
+    _frame = frame(currentframe())
+    assert "f_globals" not in _frame.__getstate__() and _frame.f_globals is globals()
+
+
 def test_generator_pickle() -> None:
     gen = Generator(simple_generator)
     attrs_before = dir(gen._internals["frame"])
@@ -209,7 +407,7 @@ def test_generator_custom_adjustment() -> None:
         "        return locals()['.internals']['.yieldfrom'].send(locals()['.internals']['.send'])",
     ]
     ## check the jump positions ##
-    assert self.jump_positions == [[1, 5]]
+    assert self.jump_positions == [[1, 4]]
     ## for ##
     self.jump_positions, self.jump_stack = [], []
     assert test("for ") == ["for "]
@@ -725,7 +923,7 @@ def test_generator_create_state() -> None:
     ## Note: the jump_positions are lineno ##
     ## based get_loops changes them to index based ##
     start_indexes = [0, 2, 4]
-    end_indexes = [13, 12, 11]
+    end_indexes = [12, 11, 10]
     gen._internals["loops"] = list(zip(start_indexes, end_indexes))
     assert test(8) == (
         [
@@ -738,6 +936,7 @@ def test_generator_create_state() -> None:
             "       else:",
             "           return 3",
             "       return 4",
+            "    print(j)",
             "    for j in locals()['.internals']['.8']:",
             "        print(j)",
             "        for k in range(4):",
@@ -773,6 +972,7 @@ def test_generator_create_state() -> None:
             8,
             9,
             10,
+            11,
             2,
             3,
             4,
@@ -797,7 +997,6 @@ def test_generator_create_state() -> None:
             10,
             11,
             12,
-            13,
         ],
     )
 
@@ -917,11 +1116,283 @@ def test_generator_frame_init() -> None:
 
     ## no local variables stored ##
     init_length, _ = gen._frame_init()
-    assert init_length == 8
-    ## with local variables stored ##
+    assert init_length == 4
+    ## with local variables stored (these are bound in bulk) ##
     gen._internals["frame"].f_locals.update({"a": 3, "b": 2, "c": 1})
     init_length, _ = gen._frame_init()
-    assert init_length == 11
+    assert init_length == 4
+    ## '.internals' is accessed via a fast local rather than locals() ##
+    assert "__internals__['EOF']()" in gen.__source__[-1]
+    next(gen)
+    assert "__internals__" not in gen._internals["frame"].f_locals
+
+
+def test_state_cache() -> None:
+    def test():
+        for i in track(range(10)):
+            yield i
+
+    state_cache.clear()
+    gen = test()
+    next(gen)
+    gen = Generator(gen)
+    assert [next(gen) for _ in range(4)] == [1, 2, 3, 4]
+    ## every step resumes at the same loop state ##
+    assert state_cache.info() == {"hits": 3, "misses": 1, "maxsize": 256, "currsize": 1}
+    ## copies share the compiled states ##
+    gen_copy = gen.copy()
+    assert next(gen_copy) == next(gen) == 5
+    assert state_cache.info()["hits"] == 5
+    ## exceptions are a part of the key ##
+    try:
+        gen.throw(ImportError)
+        assert False
+    except ImportError:
+        pass
+    assert state_cache.info()["currsize"] == 2
+
+
+def test_plan_cache() -> None:
+    def test():
+        yield 0
+        yield 1
+        yield 2
+
+    plan_cache.clear()
+    gens = [Generator(test) for _ in range(100)]
+    ## the source is processed once ##
+    assert plan_cache.info()["misses"] == 1 and plan_cache.info()["currsize"] == 1
+    for key in ("source_lines", "jump_positions", "loop_table", "fingerprint"):
+        assert gens[0]._internals[key] is gens[-1]._internals[key]
+    ## copies (e.g. via Generator__call__) share it too ##
+    gen = gens[0]()
+    assert gen._internals["source_lines"] is gens[0]._internals["source_lines"]
+    assert list(gen) == [0, 1, 2]
+    ## running generators have their own plan (since they have a linetable) ##
+    gen = test()
+    next(gen)
+    assert list(Generator(gen)) == [1, 2]
+    assert plan_cache.info()["currsize"] == 2
+    ## keyed by the identity of the code object and the hash of its source ##
+    functions = []
+    for filename, comment in (("<first>", "a"), ("<second>", "b")):
+        source = "def test():\n    yield 0  # %s\n" % comment
+        linecache.cache[filename] = (len(source), None, source.splitlines(True), filename)
+        namespace = {}
+        exec(compile(source, filename, "exec"), namespace)
+        functions += [namespace["test"]]
+    ## code objects compare equal regardless of their filename ##
+    assert functions[0].__code__ == functions[1].__code__
+    assert [Generator(FUNC)._internals["source"] for FUNC in functions] == [
+        "def test():\n    yield 0  # a\n",
+        "def test():\n    yield 0  # b\n",
+    ]
+    code_id = id(functions[0].__code__)
+    assert code_id in source_hashes
+    del functions, namespace
+    collect()
+    assert code_id not in source_hashes
+
+
+def test_disk_cache() -> None:
+    def test():
+        yield 0
+        yield 1
+
+    with TemporaryDirectory() as directory:
+        disk_cache = custom_generator.disk_cache
+        disk_cache.clear()
+        disk_cache.enabled, disk_cache.directory, custom_generator.disk_cache_states = True, directory, True
+        try:
+            plan_cache.clear()
+            state_cache.clear()
+            assert list(Generator(test)()) == [0, 1]
+            disk_cache.save()
+            ## a new process ##
+            disk_cache.clear()
+            plan_cache.clear()
+            state_cache.clear()
+            assert list(Generator(test)()) == [0, 1]
+            assert disk_cache.misses == 0 and disk_cache.hits == 3
+        finally:
+            disk_cache.enabled, disk_cache.directory, custom_generator.disk_cache_states = False, None, False
+            disk_cache.clear()
+
+
+def test_block_cache() -> None:
+    def test():
+        yield 0
+        yield 1
+
+    block_cache.clear()
+    assert list(Generator(test)()) == [0, 1]
+    assert block_cache.info()["currsize"] == 2
+    gen = Generator(test)()
+    assert list(gen) == [0, 1]
+    ## the states are shared ##
+    assert block_cache.info()["hits"] == 2
+
+
+def test_precompile() -> None:
+    def test():
+        yield 0
+        yield 1
+        yield 2
+
+    state_cache.clear()
+    gen = Generator(test, precompile=True)
+    ## the same task is used for every instance of the function ##
+    future = gen._precompile()
+    assert Generator(test, precompile=True)._precompile() is future
+    future.result()
+    assert state_cache.info()["currsize"] == 3
+    ## no states are compiled on __next__ ##
+    assert list(gen()) == [0, 1, 2]
+    assert state_cache.info()["currsize"] == 3
+
+
+def test_native_engine() -> None:
+    def test(n):
+        for i in track(range(n)):
+            yield i
+
+    gen = Generator(test, "native")(5)
+    assert gen._internals["engine"] == "native"
+    assert next(gen) == 0 and gen.gi_frame.f_locals["i"] == 0
+    assert gen.send(None) == 1
+    ## gets converted on copying (both the original and the copy) ##
+    gen_copy = gen.copy()
+    assert gen._internals["engine"] == gen_copy._internals["engine"] == "source"
+    assert list(gen_copy) == list(gen) == [2, 3, 4]
+    ## pickling ##
+    gen = Generator(test(3), "native")
+    next(gen)
+    assert list(pickle.loads(pickle.dumps(gen))) == list(gen) == [1, 2]
+    ## exhausted generators ##
+    gen = Generator(test(1), "native")
+    list(gen)
+    assert list(gen.copy()) == []
+    ## close + throw ##
+    gen = Generator(test(3), "native")
+    next(gen)
+    try:
+        gen.throw(ValueError)
+        assert False
+    except ValueError:
+        pass
+    gen = Generator(test(3), "native")
+    gen.close()
+    assert list(gen) == []
+    ## the options are kept on converting ##
+    gen = Generator(test, "native", unpacker="ast")(3)
+    next(gen)
+    gen_copy = gen.copy()
+    assert gen._internals["unpacker"] == gen_copy._internals["unpacker"] == "ast"
+    assert list(gen_copy) == list(gen) == [1, 2]
+
+
+def test_genexpr_fast_copy() -> None:
+    k = 10
+    gen = Generator((i * k for i in range(5) if i != 2), "native")
+    assert (next(gen), next(gen)) == (0, 10)
+    ## copied without converting and recreated natively on first use ##
+    gen_copy = gen.copy()
+    assert gen_copy._internals["genexpr"] and "_native" not in gen_copy.__dict__
+    assert gen._internals["engine"] == gen_copy._internals["engine"] == "native"
+    ## the for clauses are only counted once per code object ##
+    assert custom_generator.genexpr_cache.get(gen._native.gi_code) is True
+    assert list(gen_copy) == list(gen) == [30, 40]
+    ## pickling ##
+    gen = Generator((i for i in range(3)), "native")
+    next(gen)
+    assert list(pickle.loads(pickle.dumps(gen))) == list(gen) == [1, 2]
+    ## exhausted generators ##
+    assert list(gen.copy()) == []
+    ## more than one for clause gets converted ##
+    gen = Generator(((i, j) for i in range(2) for j in "ab"), "native")
+    next(gen)
+    gen.copy()
+    assert gen._internals["engine"] == "source" and "genexpr" not in gen._internals
+
+
+def test_replay_engine() -> None:
+    def test(n, m=1):
+        total = 0
+        for i in range(n):
+            x = yield i * m
+            if x:
+                total += x
+        try:
+            yield total
+        except ValueError:
+            yield "caught"
+
+    gen = Generator(test, "replay")(5, m=2)
+    assert [next(gen), gen.send(3), next(gen)] == [0, 2, 4]
+    assert gen._internals["log"] == [("send", (None,)), ("send", (3,)), ("send", (None,))]
+    ## copies are replayed on first use ##
+    gen_copy = gen.copy()
+    assert gen_copy._internals["engine"] == "replay" and "_native" not in gen_copy.__dict__
+    assert list(gen_copy) == list(gen) == [6, 8, 3]
+    ## throw ##
+    gen = Generator(test, "replay")(1)
+    next(gen), next(gen)
+    gen_copy = gen.copy()
+    assert gen_copy.throw(ValueError) == gen.throw(ValueError) == "caught"
+    ## converts to the source engine if it's estimated to be cheaper ##
+    def test(n):
+        for i in track(range(n)):
+            yield i
+
+    gen = Generator(test, "replay")(3)
+    next(gen)
+    custom_generator.replay_steps_per_line = 0
+    try:
+        gen_copy = gen.copy()
+    finally:
+        custom_generator.replay_steps_per_line = 150
+    assert gen_copy._internals["engine"] == gen._internals["engine"] == "source"
+    assert list(gen_copy) == list(gen) == [1, 2]
+    ## no arguments recorded ##
+    gen = Generator(test(3), "replay")
+    next(gen)
+    assert gen.copy()._internals["engine"] == "source"
+    ## the arguments are copied on calling ##
+    def test(values):
+        for value in values:
+            yield value
+
+    values = [1, 2, 3]
+    gen = Generator(test, "replay")(values)
+    next(gen)
+    values.clear()
+    assert list(gen.copy()) == [2, 3]
+    ## the log is dropped once it's past the estimate ##
+    gen = Generator(test, "replay")(range(3))
+    gen._internals["log_limit"] = 1
+    next(gen), next(gen)
+    assert gen._internals["log"] is None and gen.copy()._internals["engine"] == "source"
+    ## finished generators ##
+    def test():
+        yield 1
+        raise ValueError
+
+    gen = Generator(test, "replay")()
+    next(gen)
+    try:
+        next(gen)
+        assert False
+    except ValueError:
+        pass
+    assert list(gen.copy()) == []
+    ## diverging replays raise ##
+    gen = Generator(test, "replay")()
+    gen._internals["log"] += [("send", (None,))] * 2
+    try:
+        list(gen.copy())
+        assert False
+    except ValueError:
+        pass
 
 
 def test_generator_update() -> None:
@@ -1268,7 +1739,8 @@ def test_lambda_expr() -> None:
         "    for i in range(3):",
         "        return i",
     ]
-    assert gen._internals["lineno"] == 2
+    ## past the end of the loop to start its next iteration ##
+    assert gen._internals["lineno"] == 3
     assert next(gen) == 1
     ## lambda with value yields ##
     test = lambda: (yield)
@@ -1614,6 +2086,8 @@ if __name__ == "__main__":
     test_EOF()
     test_Pickler()
     test_picklers()
+    test_code_interning()
+    test_frame_snapshot()
     test_generator_pickle()
     # record_jumps is tested in test_custom_adjustment
     test_generator_custom_adjustment()
@@ -1629,6 +2103,19 @@ if __name__ == "__main__":
     test_generator__call__()
     test_generator_locals()
     test_generator_frame_init()
+    test_state_cache()
+    test_plan_cache()
+    test_disk_cache()
+    test_block_cache()
+    test_precompile()
+    test_native_engine()
+    test_genexpr_fast_copy()
+    test_replay_engine()
+    test_deferred_copy()
+    test_prune_locals()
+    test_compact_pickle()
+    test_pickle_oob()
+    test_pickle_without_copying()
     test_generator_update()
     test_generator__next__()
     test_generator__iter__()
@@ -15,6 +15,7 @@ from gcopy.source_processing import (
     extract_genexpr,
     extract_lambda,
     extract_source_from_comparison,
+    fast_internals,
     genexpr_adjust,
     get_indent,
     get_loops,
@@ -28,8 +29,12 @@ from gcopy.source_processing import (
     is_statement,
     iter_adjust,
     line_adjust,
+    live_names,
+    locate_source,
     loop_adjust,
+    loop_table,
     outer_loop_adjust,
+    resume_points,
     setup_next_line,
     sign,
     signature,
@@ -39,6 +44,7 @@ from gcopy.source_processing import (
     skip_blocks,
     skip_line_continuation,
     skip_source_definition,
+    state_names,
     string_collector_adjust,
     string_collector_proxy,
     ternary_adjust,
@@ -49,6 +55,7 @@ from gcopy.source_processing import (
     update_depth,
     yield_adjust,
 )
+from gcopy.utils import source_indexes
 
 
 def assert_cases(FUNC: FunctionType, *args, compare: list = []) -> None:
@@ -926,6 +933,7 @@ def test_loop_adjust() -> None:
             "            pass",
             "        for k in range(7):",
             "            pass",
+            "        print('hi')",
             "    if locals()['.internals']['.continue']:",
             "        for j in locals()['.internals']['.8']:",
             "            continue",
@@ -1000,10 +1008,71 @@ def test_yield_adjust() -> None:
     ]
 
 
+def test_fast_internals() -> None:
+    lines = yield_adjust("yield from range(3)", "    ")
+    assert fast_internals(lines)[2] == "        return __internals__['.i']"
+    ## strings and comments are left as is ##
+    line = "    x = \"locals()['.internals']\"  # locals()['.internals']"
+    assert fast_internals([line]) == [line]
+    ## across lines ##
+    assert fast_internals(["    f(a,", "      locals()['.internals'])"]) == ["    f(a,", "      __internals__)"]
+    ## lines that can't be tokenized are returned as is ##
+    assert fast_internals(["    f(", "locals()['.internals']"]) == ["    f(", "locals()['.internals']"]
+
+
 def test_get_loops() -> None:
     assert get_loops(3, [(1, 5), (2, 4), (6, 8)]) == [(0, 4), (1, 3)]
 
 
+def test_loop_table() -> None:
+    jump_positions = [(1, 5), (2, 4), (6, 8)]
+    table = loop_table(jump_positions, 9)
+    assert table[3] == ((0, 4), (1, 3))
+    for lineno in range(10):
+        assert list(table[lineno]) == get_loops(lineno, jump_positions)
+
+def test_resume_points() -> None:
+    source_lines = [
+        "    x = 1",
+        "    return x",
+        "    for i in range(3):",
+        "        return i",
+        "    return EOF('')",
+    ]
+    ## past the end of a loop starts its next iteration ##
+    assert resume_points(source_lines, [[3, 4]]) == [(1, ()), (3, ()), (5, ((2, 3),))]
+
+
+def test_live_names() -> None:
+    source_lines = [
+        "    buffer = [1]",
+        "    return len(buffer)",
+        "    for i in range(x):",
+        "        return i + locals()['.internals']['.send']",
+        "    return EOF('')",
+    ]
+    assert "buffer" not in live_names(source_lines, 3, ())
+    assert {"i", "x", "range"} <= live_names(source_lines, 3, ())
+    ## the encapsulating loops are included ##
+    assert "x" in live_names(source_lines, 5, ((2, 3),))
+    assert "x" not in live_names(source_lines, 5, ())
+    ## dynamic access ##
+    assert live_names(source_lines + ["    print(vars())"], 3, ()) is None
+
+
+def test_state_names() -> None:
+    state = [
+        "    for i in locals()['.internals']['.4']:",
+        "        return i + x",
+        "    data.append(y)",
+        "    return data",
+        "    return buffer",
+    ]
+    ## the lines after the first return outside of a block can't be reached ##
+    assert state_names(state) >= {"i", "x", "data", "y"}
+    assert "buffer" not in state_names(state)
+    assert state_names(["    print(locals())", "    return"]) is None
+
 def test_extract_source_from_comparison() -> None:
     ## genexpr extractor ##
     code_obj = eval("(i for i \\\n   in range(3))").gi_code
@@ -1039,6 +1108,27 @@ def test_expr_getsource() -> None:
     # print(expr_getsource(test))
 
 
+def test_locate_source() -> None:
+    a, b = lambda x: (lambda y: y), (i for i in range(3) if (j for j in range(i)))
+    assert locate_source(a.__code__) == "lambda x: (lambda y: y)"
+    assert locate_source(a(0).__code__) == "lambda y: y"
+    assert locate_source(b.gi_code) == "(i for i in range(3) if (j for j in range(i)))"
+    ## multiline ##
+    c = (
+        k for k in "é"
+    )
+    assert locate_source(c.gi_code) == '(\n        k for k in "é"\n    )'
+    ## functions ##
+    assert locate_source(test_locate_source.__code__).startswith("def test_locate_source() -> None:\n")
+    ## the file is only parsed once ##
+    source_indexes.clear()
+    locate_source(a.__code__)
+    locate_source(b.gi_code)
+    assert source_indexes.info()["misses"] == 1 and source_indexes.info()["hits"] == 1
+    ## sources that can't be found ##
+    assert locate_source(eval("lambda: 1").__code__) is None
+
+
 def test_extract_genexpr() -> None:
     source = "iter1, iter2 = (i for i in range(3)), (j for j in (i for i in range(5)) if j in (i for i in range(2)) )"
     pos = [(15, 36), (50, 71), (80, 101), (38, 103)]
@@ -1146,16 +1236,18 @@ def test_outer_loop_adjust() -> None:
     ## are in linenos ##
     length = len(source_lines) - 1
     loops = [(2 * i, length - i) for i in range(0, 3)]
-    end_pos = loops[-1][1]
+    end_pos = loops[-1][1] + 1
     assert outer_loop_adjust([], [], source_lines, loops, end_pos) == (
         [
             "    for k in locals()['.internals']['.12']:",
             "        print(k)",
+            "    print(j)",
             "    for j in locals()['.internals']['.8']:",
             "        print(j)",
             "        for k in range(4):",
             "            print(k)",
             "        print(j)",
+            "    print(i)",
             "    for i in locals()['.internals']['.4']:",
             "        print(i)",
             "        for j in range(4):",
@@ -1165,7 +1257,7 @@ def test_outer_loop_adjust() -> None:
             "            print(j)",
             "        print(i)",
         ],
-        [4, 5, 2, 3, 4, 5, 6, 0, 1, 2, 3, 4, 5, 6, 7],
+        [4, 5, 6, 2, 3, 4, 5, 6, 7, 0, 1, 2, 3, 4, 5, 6, 7],
     )
 
     ## case needs testing ##
@@ -1178,7 +1270,7 @@ def test_outer_loop_adjust() -> None:
             "            return (i,j)",
         ],
         [(0, 2), (1, 2)],
-        2,
+        3,
     ) == (
         [
             "    for j in locals()['.internals']['.8']:",
@@ -1293,9 +1385,15 @@ if __name__ == "__main__":
     test_skip_blocks()
     test_loop_adjust()
     test_yield_adjust()
+    test_fast_internals()
     test_get_loops()
+    test_loop_table()
+    test_resume_points()
+    test_live_names()
+    test_state_names()
     test_extract_source_from_comparison()
     test_expr_getsource()
+    test_locate_source()
     test_extract_genexpr()
     test_extract_lambda()
     test_extract_function()
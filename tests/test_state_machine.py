@@ -0,0 +1,203 @@
+import ast
+import pickle
+
+from gcopy.custom_generator import Generator
+from gcopy.state_machine import (
+    LocalsRewriter,
+    StateMachineError,
+    compile_machine,
+    has_escape,
+    local_names,
+)
+
+
+def simple_generator(n, m=2):
+    total = 0
+    for i in range(n):
+        if i % 2:
+            continue
+        x = yield i * m
+        if x is not None:
+            total += x
+        j = 0
+        while j < 2:
+            j += 1
+            if i == 6:
+                break
+            yield (i, j)
+        else:
+            yield "else"
+    squares = [k * k for k in range(3) if k != total]
+    try:
+        z = 1 / 0
+    except ZeroDivisionError as e:
+        z = str(e)
+    r = yield from sub_generator(2)
+    yield squares, z, r
+    return total
+
+
+def sub_generator(n):
+    for i in range(n):
+        yield "sub%s" % i
+    return "return"
+
+
+def counter(n):
+    for i in range(n):
+        yield i
+
+
+def test_has_escape() -> None:
+    test = lambda source: has_escape(ast.parse(source).body[0])
+    assert test("if a:\n    break")
+    assert test("try:\n    continue\nexcept:\n    pass")
+    assert not test("while a:\n    break")
+    ## a loops else block is not a part of the loop ##
+    assert test("for i in a:\n    pass\nelse:\n    break")
+
+
+def test_LocalsRewriter() -> None:
+    test = lambda source: ast.unparse(LocalsRewriter({"a", "b"}).visit(ast.parse(source)))
+    assert test("a = b + c") == "__locals['a'] = __locals['b'] + c"
+    ## shadowed names ##
+    assert test("lambda a: a + b") == "lambda a: a + __locals['b']"
+    assert test("[a for a in b]") == "[a for a in __locals['b']]"
+    assert test("return a") == "return (-1, __locals['a'])"
+
+
+def test_compile_machine() -> None:
+    source = "def test(a):\n    yield a\n    b = yield a + 1\n    return b\n"
+    code_obj = compile_machine(source, ("a", "b"))
+    assert code_obj.co_name == "test"
+    ## cached ##
+    assert compile_machine(source, ("a", "b")) is code_obj
+    try:
+        compile_machine("def test():\n    print((yield))\n", ())
+        assert False
+    except StateMachineError:
+        pass
+
+
+def test_local_names() -> None:
+    def test(a):
+        b = 1
+        yield lambda: b
+
+    assert local_names(test.__code__) == ("a", "b")
+
+
+def test_state_machine_engine() -> None:
+    gen = Generator(simple_generator, "state_machine")(8)
+    assert gen._internals["engine"] == "state_machine"
+    assert list(gen) == list(simple_generator(8))
+    ## send + throw ##
+    gen, native = Generator(simple_generator, "state_machine")(8), simple_generator(8)
+    assert next(gen) == next(native)
+    assert gen.send(5) == native.send(5)
+    try:
+        gen.throw(ValueError)
+        assert False
+    except ValueError:
+        pass
+    assert next(gen, True)
+    ## return value ##
+    gen = Generator(sub_generator, "state_machine")(0)
+    try:
+        next(gen)
+        assert False
+    except StopIteration as e:
+        assert e.value == "return"
+    ## generators that haven't started ##
+    gen = Generator(simple_generator(4), "state_machine")
+    assert gen._internals["engine"] == "state_machine"
+    assert list(gen) == list(simple_generator(4))
+
+
+def test_state_machine_copy() -> None:
+    gen = Generator(counter, "state_machine")(5)
+    next(gen)
+    gen_copy = gen.copy()
+    assert list(gen_copy) == list(gen) == [1, 2, 3, 4]
+    gen = Generator(counter, "state_machine")(5)
+    next(gen)
+    new_gen = pickle.loads(pickle.dumps(gen))
+    assert list(new_gen) == list(gen) == [1, 2, 3, 4]
+
+
+def test_state_machine_yield_from() -> None:
+    closed = []
+
+    def inner():
+        value = 1
+        try:
+            while True:
+                try:
+                    yield value
+                except ValueError:
+                    value = "caught"
+                except KeyError:
+                    return "done"
+        finally:
+            closed.append(True)
+
+    def outer():
+        r = yield from inner()
+        yield r
+
+    ## throw is delegated (PEP 380) ##
+    gen, native = Generator(outer, "state_machine")(), outer()
+    assert next(gen) == next(native) == 1
+    assert gen.throw(ValueError) == native.throw(ValueError) == "caught"
+    assert gen.throw(KeyError) == native.throw(KeyError) == "done"
+    assert gen._internals["yieldfrom"] is None and len(closed) == 2
+    ## uncaught exceptions close both ##
+    gen = Generator(outer, "state_machine")()
+    next(gen)
+    try:
+        gen.throw(TypeError)
+        assert False
+    except TypeError:
+        pass
+    assert len(closed) == 3 and next(gen, True)
+    ## close is delegated ##
+    gen = Generator(outer, "state_machine")()
+    next(gen)
+    gen.close()
+    assert len(closed) == 4 and next(gen, True)
+    ## iterators without throw ##
+    def outer():
+        yield from [1, 2]
+
+    gen = Generator(outer, "state_machine")()
+    next(gen)
+    try:
+        gen.throw(ValueError)
+        assert False
+    except ValueError:
+        pass
+
+
+def test_state_machine_fallback() -> None:
+    def test():
+        try:
+            yield 1
+        finally:
+            pass
+
+    assert Generator(test, "state_machine")._internals["engine"] == "source"
+    ## generators that have started ##
+    gen = counter(3)
+    next(gen)
+    assert Generator(gen, "state_machine")._internals["engine"] == "source"
+
+
+if __name__ == "__main__":
+    test_has_escape()
+    test_LocalsRewriter()
+    test_compile_machine()
+    test_local_names()
+    test_state_machine_engine()
+    test_state_machine_copy()
+    test_state_machine_yield_from()
+    test_state_machine_fallback()
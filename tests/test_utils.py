@@ -1,24 +1,38 @@
+import os
+from array import array
 import warnings
 from sys import version_info
+from tempfile import TemporaryDirectory
 from types import CodeType, FrameType
 from typing import Iterator
 
 from gcopy.utils import (
+    DiskCache,
+    LRUCache,
     attr_cmp,
     chain,
     cli_findsource,
     code_attrs,
     code_cmp,
+    dumps_oob,
     empty_generator,
+    fast_deepcopy,
     get_globals,
     get_nonlocals,
     getcode,
     getframe,
+    getsource,
+    getsourcelines,
     hasattrs,
+    immutable,
     is_cli,
     is_running,
+    loads_oob,
     similar_opcode,
     skip,
+    source_hash,
+    source_index,
+    source_indexes,
     try_set,
 )
 
@@ -231,6 +245,133 @@ def test_is_running() -> None:
     test(filter(lambda x: x, [1, 2, 3]))
 
 
+def test_source_hash() -> None:
+    lines = ["    return 1", "    return 2"]
+    assert source_hash(lines) == source_hash(list(lines))
+    assert source_hash(lines) != source_hash(lines[::-1])
+    assert source_hash(lines, [[1, 2]]) != source_hash(lines, [[1, 3]])
+
+
+def test_LRUCache() -> None:
+    cache = LRUCache(2)
+    cache["a"], cache["b"] = 1, 2
+    assert cache.get("a") == 1
+    ## "b" is the least recently used ##
+    cache["c"] = 3
+    assert "b" not in cache and len(cache) == 2
+    assert cache.get("b") is None
+    assert cache.info() == {"hits": 1, "misses": 1, "maxsize": 2, "currsize": 2}
+    cache.resize(1)
+    assert list(cache.data) == ["c"]
+    ## disabled ##
+    cache.resize(0)
+    cache["d"] = 4
+    assert "d" not in cache
+    cache.clear()
+    assert cache.info() == {"hits": 0, "misses": 0, "maxsize": 0, "currsize": 0}
+
+
+def test_DiskCache() -> None:
+    with TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "test.py")
+        with open(filename, "w") as file:
+            file.write("a = 1\n")
+        ## disabled ##
+        cache = DiskCache()
+        cache.set(filename, "a", 1)
+        assert cache.get(filename, "a") is None
+        cache.enabled = True
+        cache.set(filename, "a", (1, ["a"]))
+        cache.save()
+        assert os.path.exists(os.path.join(directory, "__pycache__"))
+        ## loaded from the file ##
+        cache.clear()
+        assert cache.get(filename, "a") == (1, ["a"])
+        ## same content (i.e. touched) ##
+        os.utime(filename, (0, 0))
+        cache.clear()
+        assert cache.get(filename, "a") == (1, ["a"])
+        ## changed content ##
+        with open(filename, "w") as file:
+            file.write("a = 2\n")
+        assert cache.get(filename, "a") is None
+        ## single directory ##
+        cache = DiskCache(True, os.path.join(directory, "cache"))
+        assert cache.path(filename).startswith(os.path.join(directory, "cache", "test-"))
+
+
+def test_source_index() -> None:
+    with TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "test.py")
+        with open(filename, "w") as file:
+            file.write("@dec\ndef test(a):\n    return (i for i in a)\n\n\nb = lambda: 1\n")
+        source_indexes.clear()
+        index = source_index(filename)
+        assert source_index(filename) is index and source_indexes.info()["misses"] == 1
+        ## functions are also indexed by their decorators ##
+        assert [type(node).__name__ for node in index.nodes[1]] == ["FunctionDef"]
+        assert [type(node).__name__ for node in index.nodes[3]] == ["GeneratorExp"]
+        namespace = {"dec": lambda FUNC: FUNC}
+        exec(compile(index.tree, filename, "exec"), namespace)
+        assert getsource(namespace["test"]) == "@dec\ndef test(a):\n    return (i for i in a)\n"
+        assert getsourcelines(namespace["test"].__code__)[1] == 1
+        ## changed files are reindexed ##
+        with open(filename, "w") as file:
+            file.write("def test():\n    yield 1\n")
+        os.utime(filename, (0, 0))
+        assert source_index(filename) is not index
+    assert source_index(filename) is None
+
+
+def test_immutable() -> None:
+    assert immutable((1, "a", frozenset((2.0, None)), range(3)))
+    assert not immutable((1, [2]))
+    assert not immutable(frozenset((1, (2, object()))))
+
+
+def test_fast_deepcopy() -> None:
+    x = [1]
+    f_locals = {"a": (1, 2), "b": frozenset("ab"), "x": x, "y": x, "z": ([2],)}
+    new = fast_deepcopy(f_locals)
+    assert new == f_locals and new is not f_locals
+    ## immutable values are shared ##
+    assert new["a"] is f_locals["a"] and new["b"] is f_locals["b"]
+    ## everything else is copied with the aliasing kept ##
+    assert new["x"] is new["y"] and new["x"] is not x and new["z"][0] is not f_locals["z"][0]
+    ## one memo across calls ##
+    memo = {}
+    assert fast_deepcopy(x, memo) is fast_deepcopy([x], memo)[0]
+
+
+def test_dumps_oob() -> None:
+    obj = {
+        "bytes": bytes(100),
+        "bytearray": bytearray(b"a" * 100),
+        "array": array("d", range(20)),
+        "memoryview": memoryview(array("i", range(40))).cast("B").cast("i", (2, 20)),
+        "small": b"abc",
+    }
+    data, buffers = dumps_oob(obj, 100)
+    assert len(buffers) == 4 and len(data) < 200
+    new = loads_oob(data, buffers)
+    assert new == obj and new["memoryview"].shape == (2, 20)
+    ## buffers of the same type aren't copied ##
+    buffer = bytearray(buffers[1].raw())
+    assert loads_oob(data, [buffers[0], buffer, buffers[2], buffers[3]])["bytearray"] is buffer
+    ## in-band (memoryviews can only be pickled out-of-band) ##
+    assert len(dumps_oob(obj)[1]) == 1
+    ## memoryviews that aren't C-contiguous are copied (in-band if they're small) ##
+    views = [
+        memoryview(bytearray(range(200)))[::2],
+        memoryview(array("i", range(40))).cast("B").cast("i", (2, 20))[::-1],
+    ]
+    data, buffers = dumps_oob(views)
+    new = loads_oob(data, buffers)
+    assert not buffers and new == views and new[0].tolist() == list(range(0, 200, 2)) and not new[0].readonly
+    data, buffers = dumps_oob(views, 10)
+    assert len(buffers) == 2 and loads_oob(data, [buffer.raw() for buffer in buffers]) == views
+
+
 if __name__ == "__main__":
     # TODO can remove, simply run pytest .
     ## is_cli is tested in test_cli_findsource ##
@@ -252,3 +393,10 @@ if __name__ == "__main__":
     test_similar_opcode()
     test_code_cmp()
     test_is_running()
+    test_source_hash()
+    test_LRUCache()
+    test_DiskCache()
+    test_source_index()
+    test_immutable()
+    test_fast_deepcopy()
+    test_dumps_oob()